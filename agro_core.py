@@ -1,12 +1,30 @@
+import atexit
+import heapq
+import json
+import math
+import os
+import shutil
 import sqlite3
+import threading
+import time
+import warnings
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from geopy.geocoders import Nominatim
+from geopy.extra.rate_limiter import RateLimiter
+import agro_metrics
 
 # ==========================================
 # ⚙️ CENTRAL CONFIGURATION
 # ==========================================
 DB_NAME = "agro_data.db"
+SNAPSHOT_DIR = "market_snapshot"   # columnar copy of mandi_prices (export_snapshot), not committed
+SNAPSHOT_AUTO_BUILD = True         # readers rebuild a missing/stale snapshot on first use
 TRUSTED_STATES = ["Haryana", "Rajasthan", "Andhra Pradesh", "Telangana", "Madhya Pradesh", "Chhattisgarh"]
 
 CROP_PROFILES = {
@@ -21,125 +39,1420 @@ CROP_PROFILES = {
     "default": {"wastage": 0.03, "labor": 15}
 }
 
-geolocator = Nominatim(user_agent="agro_pro_v3")
+# Search terms that differ from how the national feed spells a commodity (term -> feed commodity key)
+COMMODITY_SYNONYMS = {
+    "soybean": "soyabean",
+    "dhan": "paddy",
+    "okra": "bhindi",
+    "ladies finger": "bhindi",
+    "chana": "bengal gram",
+    "groundnut": "groundnut pods",
+}
 
-# --- THE NEW CACHING SYSTEM ---
-def _setup_cache_tables():
-    """Silently creates the memory tables inside your database if they don't exist."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS location_cache (city_name TEXT PRIMARY KEY, lat REAL, lon REAL)''')
-    cursor.execute('''CREATE TABLE IF NOT EXISTS route_cache (origin TEXT, destination TEXT, distance_km REAL, UNIQUE(origin, destination))''')
-    conn.commit()
-    conn.close()
+# Cost model defaults (the app's custom overrides replace the rate, tax and labor per request)
+MANDI_TAX = 0.03           # share of buy cost + sell revenue paid as mandi fees
+TRUCK_TIERS = {            # capacity in quintals, freight in ₹/km
+    "small": {"capacity": 50, "rate": 25},
+    "standard": {"capacity": 100, "rate": 35},
+    "large": {"capacity": 250, "rate": 60},
+}
+DEFAULT_TRUCK = "standard"
+# (from_km, rate multiplier) bands, charged like tax brackets; e.g. ((0, 1.0), (300, 0.85)) makes long hauls cheaper per km
+FREIGHT_BANDS = ((0, 1.0),)
 
-# Run setup immediately when this file is loaded
-_setup_cache_tables()
+# OSRM routing (point OSRM_URL at a self-hosted or stand-in server to lift the demo limits)
+OSRM_URL = "http://router.project-osrm.org"
+OSRM_TIMEOUT = 15          # seconds per HTTP request
+OSRM_TABLE_CHUNK = 50      # sources x destinations per /table call (demo server caps at 100 coords)
+OSRM_WORKERS = 4           # table chunks in flight at once
+OSRM_MIN_INTERVAL = 1.0    # seconds between request starts (demo server policy is 1 req/s)
 
-def get_coordinates(city_name):
-    """Checks the local database first. If missing, fetches from internet and saves it."""
-    clean_name = city_name.split('(')[0].replace('APMC', '').replace('Veg', '').strip()
-    
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # 1. Check local cache (Instant)
-    cursor.execute("SELECT lat, lon FROM location_cache WHERE city_name = ?", (clean_name,))
-    cached = cursor.fetchone()
-    if cached:
-        conn.close()
-        return cached 
-        
-    # 2. Ask internet (Slow)
+# Spatial pre-filter: a road is never shorter than the great-circle distance between its ends
+ROAD_FACTOR_MIN = 1.0
+EARTH_RADIUS_KM = 6371.0
+GRID_CELL_DEG = 1.0        # ~111 km grid cells for the market spatial index
+
+# Geocoding (Nominatim usage policy is max 1 req/s)
+GEOCODE_MIN_INTERVAL = 1.0
+GEOCODE_MISS_TTL_DAYS = 30     # how long a "not found" answer is trusted before retrying
+GAZETTEER_CSV = "market_gazetteer.csv"   # optional offline name,lat,lon file
+
+# Post-ingest daily_deals table: every route within DEALS_MAX_KM that clears DEALS_MIN_PROFIT at default
+# costs, built by db_updater. find_routes and the bot read it whenever it covers a query; keep these in
+# step with TRUSTED_STATES and telegram_alert's VIP_REGIONS / SCAN_CROPS.
+DEAL_CROPS = ['Tomato', 'Soybean', 'Paddy', 'Wheat', 'Mustard', 'Onion', 'Potato', 'Maize']
+DEAL_STATES = sorted(set(TRUSTED_STATES) | {"Madhya Pradesh", "Chattisgarh", "Haryana", "Rajasthan", "Punjab"})
+DEALS_MAX_KM = 450
+DEALS_MIN_PROFIT = 0       # loss-making routes are not stored, which keeps the committed database small
+
+# Price history retention (db_updater prunes to these; see its size budget)
+HISTORY_DAILY_DAYS = 28    # price_history keeps daily points this long, then rolls them into weekly means
+HISTORY_WEEKLY_WEEKS = 26  # weekly rollups (price_history_weekly) older than this are dropped
+
+geolocator = Nominatim(user_agent="agro_pro_v3", timeout=10)
+_geocode = RateLimiter(geolocator.geocode, min_delay_seconds=GEOCODE_MIN_INTERVAL, max_retries=2, swallow_exceptions=False)
+
+_http_session = None
+_http_lock = threading.Lock()
+_last_request_at = 0.0
+
+def _get_http_session():
+    """One pooled keep-alive session for every OSRM call, with retry/backoff on transient errors."""
+    global _http_session
+    if _http_session is None:
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=OSRM_WORKERS, max_retries=retry)
+        _http_session = requests.Session()
+        _http_session.mount("http://", adapter)
+        _http_session.mount("https://", adapter)
+    return _http_session
+
+def _throttle():
+    """Spaces out request starts across all worker threads to respect OSRM_MIN_INTERVAL."""
+    global _last_request_at
+    with _http_lock:
+        wait = _last_request_at + OSRM_MIN_INTERVAL - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        _last_request_at = time.monotonic()
+
+def _osrm_get(path):
+    _throttle()
+    with agro_metrics.external("osrm"):
+        res = _get_http_session().get(f"{OSRM_URL}{path}", timeout=OSRM_TIMEOUT)
+        res.raise_for_status()
+        return res.json()
+
+def clean_market_name(city_name):
+    """Cache key for a market or city name (drops "(...)" suffixes and APMC/Veg tags)."""
+    return city_name.split('(')[0].replace('APMC', '').replace('Veg', '').strip()
+
+# --- SHARED DATABASE CONNECTION ---
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS location_cache (city_name TEXT PRIMARY KEY, lat REAL, lon REAL)",
+    "CREATE TABLE IF NOT EXISTS route_cache (origin TEXT, destination TEXT, distance_km REAL, UNIQUE(origin, destination))",
+    # Names Nominatim could not place, so they are not re-geocoded on every scan
+    "CREATE TABLE IF NOT EXISTS location_misses (city_name TEXT PRIMARY KEY, checked_at REAL)",
+    # Where an interrupted db_updater feed walk should resume (one row per feed)
+    "CREATE TABLE IF NOT EXISTS ingest_checkpoint (feed TEXT PRIMARY KEY, run_day TEXT, next_offset INTEGER, total INTEGER, finished INTEGER)",
+    # One row per db_updater run, plus the prices it actually inserted or changed (old_price NULL = new row)
+    "CREATE TABLE IF NOT EXISTS update_runs (run_id INTEGER PRIMARY KEY AUTOINCREMENT, started_at TEXT, finished_at TEXT, rows_seen INTEGER DEFAULT 0, rows_new INTEGER DEFAULT 0, rows_changed INTEGER DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS price_changes (run_id INTEGER, state TEXT, market TEXT, commodity TEXT, arrival_date TEXT, old_price REAL, new_price REAL)",
+    "CREATE INDEX IF NOT EXISTS idx_price_changes_run ON price_changes (run_id, commodity)",
+    # Materialized routes (build_daily_deals) and which (commodity, state) slices they are current for
+    """CREATE TABLE IF NOT EXISTS daily_deals (
+        commodity_id INTEGER NOT NULL, origin TEXT NOT NULL, destination TEXT NOT NULL, origin_id INTEGER, destination_id INTEGER,
+        origin_state TEXT, destination_state TEXT, origin_date TEXT, destination_date TEXT,
+        buy_price REAL, sell_price REAL, distance_km REAL,
+        net_profit REAL, gross_profit REAL, wastage_loss REAL, fees_and_labor REAL, freight REAL,
+        PRIMARY KEY (commodity_id, origin, destination)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS idx_daily_deals_profit ON daily_deals (commodity_id, net_profit DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_daily_deals_origin ON daily_deals (commodity_id, origin_id, net_profit DESC)",
+    "CREATE TABLE IF NOT EXISTS daily_deals_coverage (commodity_id INTEGER, state TEXT, run_id INTEGER, arrival_date TEXT, PRIMARY KEY (commodity_id, state))",
+)
+
+class _ThreadConnection:
+    """Owns one thread's connection; closing it when the thread's local storage is dropped at thread exit."""
+    __slots__ = ("conn", "db_name", "__weakref__")
+
+    def __init__(self, conn, db_name):
+        self.conn, self.db_name = conn, db_name
+
+    def __del__(self):
+        try:
+            self.conn.close()
+        except sqlite3.Error:
+            pass
+
+_local = threading.local()
+# Weak, so short-lived threads (Streamlit starts one per rerun) release their connection when they finish
+_open_connections = weakref.WeakSet()
+_schema_ready = set()
+_conn_lock = threading.Lock()
+
+def _migrate_mandi_prices_v1(conn):
+    """ISO arrival dates, one row per (state, market, commodity, day) and covering indexes."""
+    conn.execute("""
+        CREATE TABLE mandi_prices_v1 (
+            state TEXT NOT NULL, market TEXT NOT NULL, commodity TEXT NOT NULL,
+            modal_price REAL, arrival_date TEXT NOT NULL,
+            UNIQUE(state, market, commodity, arrival_date)
+        )
+    """)
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'mandi_prices'").fetchone()
+    if exists:
+        # dd/mm/yyyy -> yyyy-mm-dd; rows are replayed oldest first so the newest duplicate wins
+        conn.execute("""
+            INSERT OR REPLACE INTO mandi_prices_v1 (state, market, commodity, modal_price, arrival_date)
+            SELECT state, market, commodity, modal_price,
+                   CASE WHEN arrival_date LIKE '__/__/____'
+                        THEN substr(arrival_date, 7, 4) || '-' || substr(arrival_date, 4, 2) || '-' || substr(arrival_date, 1, 2)
+                        ELSE arrival_date END
+            FROM mandi_prices
+            WHERE state IS NOT NULL AND market IS NOT NULL AND commodity IS NOT NULL AND arrival_date IS NOT NULL
+            ORDER BY rowid
+        """)
+        conn.execute("DROP TABLE mandi_prices")
+    conn.execute("ALTER TABLE mandi_prices_v1 RENAME TO mandi_prices")
+    conn.execute("CREATE INDEX idx_mandi_commodity_date ON mandi_prices (commodity, arrival_date, state, market, modal_price)")
+    conn.execute("CREATE INDEX idx_mandi_date_state ON mandi_prices (arrival_date, state, commodity, modal_price)")
+
+# Day numbers (days since 1970-01-01) keep the history tables compact and make ranges integer comparisons
+DAY_NUMBER_SQL = "CAST(strftime('%s', {col}) / 86400 AS INTEGER)"
+
+def _migrate_price_history_v2(conn):
+    """Long-lived daily price history (plus weekly rollups) outside the 7-day hot table, backfilled from it."""
+    conn.execute("""
+        CREATE TABLE price_history (
+            commodity TEXT NOT NULL, market TEXT NOT NULL, state TEXT NOT NULL, day INTEGER NOT NULL, price REAL,
+            PRIMARY KEY (commodity, market, state, day)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE price_history_weekly (
+            commodity TEXT NOT NULL, market TEXT NOT NULL, state TEXT NOT NULL, week INTEGER NOT NULL,
+            mean_price REAL, min_price REAL, max_price REAL, samples INTEGER,
+            PRIMARY KEY (commodity, market, state, week)
+        ) WITHOUT ROWID
+    """)
+    conn.execute(f"""
+        INSERT INTO price_history (commodity, market, state, day, price)
+        SELECT commodity, market, state, {DAY_NUMBER_SQL.format(col='arrival_date')}, modal_price FROM mandi_prices
+    """)
+
+def _migrate_name_index_v3(conn):
+    """Market id/alias tables, a trigram search index, and integer ids on mandi_prices (commodity ids: v4)."""
+    conn.execute("CREATE TABLE markets (market_id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, name TEXT NOT NULL)")
+    conn.execute("CREATE TABLE market_aliases (alias TEXT PRIMARY KEY, market_id INTEGER NOT NULL) WITHOUT ROWID")
     try:
-        location = geolocator.geocode(f"{clean_name}, India")
-        if location:
-            # 3. Save to local DB for next time
-            cursor.execute("INSERT OR REPLACE INTO location_cache (city_name, lat, lon) VALUES (?, ?, ?)", 
-                           (clean_name, location.latitude, location.longitude))
-            conn.commit()
-            conn.close()
-            return (location.latitude, location.longitude)
+        conn.execute("CREATE VIRTUAL TABLE name_search USING fts5(alias, kind UNINDEXED, ref_id UNINDEXED, tokenize = 'trigram')")
+    except sqlite3.OperationalError as e:
+        # search_names falls back to a LIKE scan of the alias tables
+        print(f"⚠️ SQLite has no FTS5 trigram tokenizer ({e}); fuzzy name search will be slower.")
+
+    conn.execute("ALTER TABLE mandi_prices ADD COLUMN commodity_id INTEGER")
+    conn.execute("ALTER TABLE mandi_prices ADD COLUMN market_id INTEGER")
+    ids = register_names(conn, "market", [m for (m,) in conn.execute("SELECT DISTINCT market FROM mandi_prices")])
+    conn.execute("CREATE TEMP TABLE name_ids (raw TEXT PRIMARY KEY, ref_id INTEGER)")
+    conn.executemany("INSERT INTO temp.name_ids VALUES (?, ?)", ids.items())
+    conn.execute("UPDATE mandi_prices SET market_id = (SELECT ref_id FROM temp.name_ids WHERE raw = mandi_prices.market)")
+    conn.execute("DROP TABLE temp.name_ids")
+
+    # Commodity filters are integer comparisons now, so the text-keyed index is replaced
+    conn.execute("DROP INDEX IF EXISTS idx_mandi_commodity_date")
+    conn.execute("CREATE INDEX idx_mandi_commodity_id ON mandi_prices (commodity_id, arrival_date, state, market, modal_price)")
+
+def _migrate_commodity_varieties_v4(conn):
+    """One commodity id per feed variety; base names and synonyms become aliases shared by all varieties.
+
+    v3 merged varieties ("Paddy(Dhan)(Common)", "Paddy(Dhan)(Basmati)") into one id, so routes could
+    pair a cheap variety's buy price with a dear one's sell price. Ids are rebuilt and every table
+    keyed on them is cleared for the updater to refill.
+    """
+    conn.execute("DROP TABLE IF EXISTS commodities")
+    conn.execute("DROP TABLE IF EXISTS commodity_aliases")
+    conn.execute("CREATE TABLE commodities (commodity_id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE, name TEXT NOT NULL)")
+    conn.execute("CREATE TABLE commodity_aliases (alias TEXT NOT NULL, commodity_id INTEGER NOT NULL, PRIMARY KEY (alias, commodity_id)) WITHOUT ROWID")
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'name_search'").fetchone():
+        conn.execute("DELETE FROM name_search WHERE kind = 'commodity'")
+
+    ids = register_names(conn, "commodity", [c for (c,) in conn.execute("SELECT DISTINCT commodity FROM mandi_prices")])
+    conn.execute("CREATE TEMP TABLE name_ids (raw TEXT PRIMARY KEY, ref_id INTEGER)")
+    conn.executemany("INSERT INTO temp.name_ids VALUES (?, ?)", ids.items())
+    conn.execute("UPDATE mandi_prices SET commodity_id = (SELECT ref_id FROM temp.name_ids WHERE raw = mandi_prices.commodity)")
+    conn.execute("DROP TABLE temp.name_ids")
+    conn.execute("DELETE FROM daily_deals")
+    conn.execute("DELETE FROM daily_deals_coverage")
+
+def _migrate_history_ids_v5(conn):
+    """Keys price_history and price_history_weekly on commodity_id, so history lookups resolve names like prices do."""
+    history = {}
+    for table in ("price_history", "price_history_weekly"):
+        history.update(register_names(conn, "commodity", [c for (c,) in conn.execute(f"SELECT DISTINCT commodity FROM {table}")]))
+    conn.execute("CREATE TEMP TABLE name_ids (raw TEXT PRIMARY KEY, ref_id INTEGER)")
+    conn.executemany("INSERT INTO temp.name_ids VALUES (?, ?)", history.items())
+
+    conn.execute("""
+        CREATE TABLE price_history_v5 (
+            commodity_id INTEGER NOT NULL, market TEXT NOT NULL, state TEXT NOT NULL, day INTEGER NOT NULL, price REAL,
+            PRIMARY KEY (commodity_id, market, state, day)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO price_history_v5 (commodity_id, market, state, day, price)
+        SELECT n.ref_id, h.market, h.state, h.day, h.price FROM price_history h JOIN temp.name_ids n ON n.raw = h.commodity
+    """)
+    conn.execute("""
+        CREATE TABLE price_history_weekly_v5 (
+            commodity_id INTEGER NOT NULL, market TEXT NOT NULL, state TEXT NOT NULL, week INTEGER NOT NULL,
+            mean_price REAL, min_price REAL, max_price REAL, samples INTEGER,
+            PRIMARY KEY (commodity_id, market, state, week)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO price_history_weekly_v5 (commodity_id, market, state, week, mean_price, min_price, max_price, samples)
+        SELECT n.ref_id, w.market, w.state, w.week, w.mean_price, w.min_price, w.max_price, w.samples
+        FROM price_history_weekly w JOIN temp.name_ids n ON n.raw = w.commodity
+    """)
+    conn.execute("DROP TABLE temp.name_ids")
+    for table in ("price_history", "price_history_weekly"):
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {table}_v5 RENAME TO {table}")
+
+# Applied in order; PRAGMA user_version records how many have run against a database file
+_MIGRATIONS = (
+    _migrate_mandi_prices_v1,
+    _migrate_price_history_v2,
+    _migrate_name_index_v3,
+    _migrate_commodity_varieties_v4,
+    _migrate_history_ids_v5,
+)
+
+def _ensure_schema(conn):
+    """Creates the cache tables and applies pending migrations the first time this process touches a database file."""
+    with _conn_lock:
+        if DB_NAME in _schema_ready:
+            return
+        with conn:
+            for ddl in _SCHEMA:
+                conn.execute(ddl)
+
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < len(_MIGRATIONS):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Re-read inside the write lock in case another process migrated first
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for step, migrate in enumerate(_MIGRATIONS[version:], start=version + 1):
+                    print(f"🛠️ Migrating database schema to v{step}...")
+                    migrate(conn)
+                    conn.execute(f"PRAGMA user_version = {step}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            # Reclaim the pages freed by the rebuild and keep freeing them as old rows are pruned
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        _schema_ready.add(DB_NAME)
+
+def get_connection():
+    """Returns this thread's long-lived connection to DB_NAME (WAL mode, tuned pragmas, schema ready).
+
+    Connections are reused for the life of the thread, so sqlite3's per-connection statement
+    cache keeps every query in this module prepared after its first run, and are closed when
+    the thread ends.
+    """
+    holder = getattr(_local, "holder", None)
+    if holder is not None and holder.db_name == DB_NAME:
+        return holder.conn
+
+    conn = sqlite3.connect(DB_NAME, timeout=30, check_same_thread=False, cached_statements=256)
+    conn.execute("PRAGMA journal_mode = WAL")      # readers never block the writer and vice versa
+    conn.execute("PRAGMA synchronous = NORMAL")    # safe with WAL, far fewer fsyncs
+    conn.execute("PRAGMA busy_timeout = 30000")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -20000")     # ~20 MB page cache
+    conn.execute("PRAGMA mmap_size = 268435456")
+    _ensure_schema(conn)
+
+    holder = _ThreadConnection(conn, DB_NAME)
+    with _conn_lock:
+        _open_connections.add(holder)
+    # Replacing the previous holder (another DB_NAME) closes that connection
+    _local.holder = holder
+    return conn
+
+@atexit.register
+def close_connections():
+    """Checkpoints the WAL back into the main file and closes every connection of a still-running thread.
+
+    The daily workflow commits agro_data.db on its own, so nothing may be left behind in -wal.
+    """
+    with _conn_lock:
+        holders = list(_open_connections)
+        _open_connections.clear()
+    for holder in holders:
+        try:
+            holder.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            holder.conn.close()
+        except sqlite3.Error:
+            pass
+    _local.__dict__.clear()
+
+# --- MARKET LOCATION INDEX ---
+_location_index = None
+_location_misses = None
+_location_index_db = None
+
+def load_location_index(refresh=False):
+    """Loads every cached market coordinate into memory once per process: {clean_name: (lat, lon)}."""
+    global _location_index, _location_misses, _location_index_db
+    if _location_index is None or refresh or _location_index_db != DB_NAME:
+        conn = get_connection()
+        _location_index = {name: (lat, lon) for name, lat, lon in conn.execute("SELECT city_name, lat, lon FROM location_cache")}
+        fresh_after = time.time() - GEOCODE_MISS_TTL_DAYS * 86400
+        _location_misses = {name for (name,) in conn.execute("SELECT city_name FROM location_misses WHERE checked_at >= ?", (fresh_after,))}
+        _location_index_db = DB_NAME
+    return _location_index
+
+def _geocode_and_store(clean_name):
+    """One throttled Nominatim lookup; the answer (hit or miss) is persisted and added to the in-memory index."""
+    conn = get_connection()
+    try:
+        with agro_metrics.external("nominatim"):
+            location = _geocode(f"{clean_name}, India")
     except Exception as e:
-        pass
-    
-    conn.close()
+        print(f"Geocode error for {clean_name}: {e}")
+        return None
+
+    with conn:
+        if location:
+            conn.execute("INSERT OR REPLACE INTO location_cache (city_name, lat, lon) VALUES (?, ?, ?)",
+                         (clean_name, location.latitude, location.longitude))
+            conn.execute("DELETE FROM location_misses WHERE city_name = ?", (clean_name,))
+        else:
+            conn.execute("INSERT OR REPLACE INTO location_misses (city_name, checked_at) VALUES (?, ?)", (clean_name, time.time()))
+
+    if location:
+        _location_index[clean_name] = (location.latitude, location.longitude)
+        return _location_index[clean_name]
+    _location_misses.add(clean_name)
     return None
 
+def get_coordinates(city_name):
+    """Checks the in-memory location index first. If missing (and not a recent miss), geocodes it and saves it."""
+    clean_name = clean_market_name(city_name)
+    index = load_location_index()
+    if clean_name in index:
+        agro_metrics.cache_lookup("location_cache", True)
+        return index[clean_name]
+    if clean_name in _location_misses:
+        agro_metrics.cache_lookup("location_misses", True)
+        return None
+    agro_metrics.cache_lookup("location_cache", False)
+    return _geocode_and_store(clean_name)
+
+def import_gazetteer(csv_path=None):
+    """Bulk-loads market coordinates from a local CSV with name, lat, lon columns. Returns rows imported."""
+    csv_path = csv_path or GAZETTEER_CSV
+    df = pd.read_csv(csv_path).dropna(subset=['name', 'lat', 'lon'])
+    rows = [(clean_market_name(str(r.name)), float(r.lat), float(r.lon)) for r in df.itertuples(index=False)]
+    conn = get_connection()
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO location_cache (city_name, lat, lon) VALUES (?, ?, ?)", rows)
+        conn.executemany("DELETE FROM location_misses WHERE city_name = ?", [(name,) for name, _, _ in rows])
+    load_location_index(refresh=True)
+    print(f"🗺️ Imported {len(rows)} market locations from {csv_path}.")
+    return len(rows)
+
+@agro_metrics.timed("resolve_new_markets")
+def resolve_new_markets(limit=None):
+    """Geocodes every market in mandi_prices that is not in the index yet, as one throttled batch job."""
+    index = load_location_index(refresh=True)
+    names = {clean_market_name(m) for (m,) in get_connection().execute("SELECT DISTINCT market FROM mandi_prices")}
+    pending = sorted(n for n in names if n and n not in index and n not in _location_misses)
+    if limit is not None:
+        pending = pending[:limit]
+    if not pending:
+        return 0, 0
+
+    print(f"🧭 Geocoding {len(pending)} new markets (~{len(pending) * GEOCODE_MIN_INTERVAL:.0f}s)...")
+    found = sum(1 for name in pending if _geocode_and_store(name))
+    print(f"✅ Located {found} markets, {len(pending) - found} unresolved.")
+    return found, len(pending) - found
+
 def get_driving_distance(c1, c2, city1_name, city2_name):
     """Checks local database for the route. If missing, calculates via OSRM and saves it."""
-    clean_city1 = city1_name.split('(')[0].replace('APMC', '').replace('Veg', '').strip()
-    clean_city2 = city2_name.split('(')[0].replace('APMC', '').replace('Veg', '').strip()
-    
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    clean_city1 = clean_market_name(city1_name)
+    clean_city2 = clean_market_name(city2_name)
+    conn = get_connection()
     
     # 1. Check local cache (Instant)
-    cursor.execute("SELECT distance_km FROM route_cache WHERE origin = ? AND destination = ?", (clean_city1, clean_city2))
-    cached = cursor.fetchone()
+    cached = conn.execute("SELECT distance_km FROM route_cache WHERE origin = ? AND destination = ?", (clean_city1, clean_city2)).fetchone()
+    agro_metrics.cache_lookup("route_cache", bool(cached))
     if cached:
-        conn.close()
         return cached[0]
         
     # 2. Ask internet (Slow)
     try:
-        url = f"http://router.project-osrm.org/route/v1/driving/{c1[1]},{c1[0]};{c2[1]},{c2[0]}?overview=false"
-        res = requests.get(url).json()
+        res = _osrm_get(f"/route/v1/driving/{c1[1]},{c1[0]};{c2[1]},{c2[0]}?overview=false")
         if res.get('code') == 'Ok':
             dist = res['routes'][0]['distance'] / 1000.0
             
             # 3. Save BOTH directions to DB to make future queries 2x faster
-            cursor.execute("INSERT OR IGNORE INTO route_cache (origin, destination, distance_km) VALUES (?, ?, ?)", (clean_city1, clean_city2, dist))
-            cursor.execute("INSERT OR IGNORE INTO route_cache (origin, destination, distance_km) VALUES (?, ?, ?)", (clean_city2, clean_city1, dist))
-            conn.commit()
-            conn.close()
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO route_cache (origin, destination, distance_km) VALUES (?, ?, ?)", (clean_city1, clean_city2, dist))
+                conn.execute("INSERT OR IGNORE INTO route_cache (origin, destination, distance_km) VALUES (?, ?, ?)", (clean_city2, clean_city1, dist))
             return dist
     except Exception as e:
-        pass
+        agro_metrics.error("osrm.route", e)
+        print(f"OSRM route error for {clean_city1} -> {clean_city2}: {e}")
         
-    conn.close()
     return None
 
+# --- COMMODITY / MARKET NAME INDEX ---
+def normalize_name(text):
+    """Lower-cased, whitespace-collapsed form every alias is stored under."""
+    return " ".join(str(text).lower().split())
+
+def commodity_key(name):
+    """Base commodity a feed variety belongs to, with variety suffixes dropped ("Paddy(Dhan)(Common)" -> "paddy")."""
+    return normalize_name(str(name).split('(')[0])
+
+def market_key(name):
+    """One key per market, built from the same cleanup as the location/route cache keys."""
+    return normalize_name(clean_market_name(str(name)))
+
+def _commodity_aliases(raw):
+    # Every variety answers to its own spelling, its base commodity and that base's synonyms
+    base = commodity_key(raw)
+    return {normalize_name(raw), base, *(term for term, target in COMMODITY_SYNONYMS.items() if target == base)}
+
+def _market_aliases(raw):
+    return {normalize_name(raw), market_key(raw)}
+
+# kind -> (table, alias table, id column, key function, display name function, aliases function)
+# Each feed commodity string (variety) is its own commodity; its base name is a shared alias, so one
+# query can resolve to several varieties. Market spellings of the same place share one id.
+_NAME_TABLES = {
+    "commodity": ("commodities", "commodity_aliases", "commodity_id", normalize_name, lambda raw: " ".join(str(raw).split()), _commodity_aliases),
+    "market": ("markets", "market_aliases", "market_id", market_key, clean_market_name, _market_aliases),
+}
+
+def register_names(conn, kind, names):
+    """Maps raw feed names of one kind ("commodity" or "market") to integer ids, adding unseen ones.
+
+    A new name is stored under its aliases (see _NAME_TABLES) and added to the trigram search
+    index. Runs inside the caller's transaction.
+    """
+    table, alias_table, id_col, key_fn, display_fn, aliases_fn = _NAME_TABLES[kind]
+    has_search = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'name_search'").fetchone() is not None
+    ids = {}
+    for raw in set(names):
+        key = key_fn(raw)
+        row = conn.execute(f"SELECT {id_col} FROM {table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            row = (conn.execute(f"INSERT INTO {table} (key, name) VALUES (?, ?)", (key, display_fn(raw))).lastrowid,)
+        known = conn.execute(f"SELECT 1 FROM {alias_table} WHERE alias = ? AND {id_col} = ?", (normalize_name(raw), row[0])).fetchone()
+        if known is None:
+            for a in aliases_fn(raw):
+                added = conn.execute(f"INSERT OR IGNORE INTO {alias_table} (alias, {id_col}) VALUES (?, ?)", (a, row[0])).rowcount
+                if added and has_search:
+                    conn.execute("INSERT INTO name_search (alias, kind, ref_id) VALUES (?, ?, ?)", (a, kind, row[0]))
+        ids[raw] = row[0]
+    return ids
+
+def _resolve_name(kind, query):
+    """Ids whose alias is the query's exact spelling, else its key (base commodity / cleaned market name)."""
+    _, alias_table, id_col, _, _, _ = _NAME_TABLES[kind]
+    conn = get_connection()
+    base = commodity_key(query) if kind == "commodity" else market_key(query)
+    for alias in dict.fromkeys((normalize_name(query), base)):
+        ids = [ref for (ref,) in conn.execute(f"SELECT {id_col} FROM {alias_table} WHERE alias = ? ORDER BY {id_col}", (alias,))]
+        if ids:
+            return tuple(ids)
+    return ()
+
+def resolve_commodity(query):
+    """commodity_ids for a commodity name, feed spelling or synonym (case-insensitive); () if unknown.
+
+    A full feed spelling ("Paddy(Dhan)(Common)") resolves to that one variety, a base name or
+    synonym ("paddy", "dhan") to every variety of it. Prices of different ids are never compared.
+    """
+    return _resolve_name("commodity", query)
+
+def resolve_market(query):
+    """market_id for a market name or feed spelling (case-insensitive); None if unknown."""
+    ids = _resolve_name("market", query)
+    return ids[0] if ids else None
+
+def commodity_names(ids):
+    """{commodity_id: display name} for the given ids (the feed's variety spelling)."""
+    ids = list(ids)
+    if not ids:
+        return {}
+    return dict(get_connection().execute(
+        f"SELECT commodity_id, name FROM commodities WHERE commodity_id IN ({', '.join(['?'] * len(ids))})", ids).fetchall())
+
+def search_names(text, kind="commodity", limit=5):
+    """Fuzzy name lookup for free-text boxes: [(id, name)] best first, tolerant of typos and partial names.
+
+    Ranks aliases by the trigrams they share with `text` using the FTS5 trigram index.
+    """
+    table, alias_table, id_col, _, _, _ = _NAME_TABLES[kind]
+    query = normalize_name(text)
+    grams = sorted({query[i:i + 3] for i in range(len(query) - 2)})
+    if not grams:
+        return []
+    conn = get_connection()
+    exact = _resolve_name(kind, text)
+    try:
+        match = " OR ".join('"' + g.replace('"', '""') + '"' for g in grams)
+        rows = conn.execute(f"""
+            SELECT t.{id_col}, t.name, MIN(s.rank) AS best
+            FROM name_search s JOIN {table} t ON t.{id_col} = s.ref_id
+            WHERE name_search MATCH ? AND s.kind = ?
+            GROUP BY t.{id_col} ORDER BY best LIMIT ?
+        """, (f"alias : ({match})", kind, limit + 1)).fetchall()
+    except sqlite3.OperationalError:
+        rows = conn.execute(f"""
+            SELECT DISTINCT t.{id_col}, t.name, 0 FROM {alias_table} a JOIN {table} t ON t.{id_col} = a.{id_col}
+            WHERE a.alias LIKE ? LIMIT ?
+        """, (f"%{query}%", limit + 1)).fetchall()
+
+    found = [(ref, name) for ref, name, _ in rows if ref not in exact]
+    found[:0] = [(ref, conn.execute(f"SELECT name FROM {table} WHERE {id_col} = ?", (ref,)).fetchone()[0]) for ref in exact]
+    return found[:limit]
+
+# --- COLUMNAR SNAPSHOT ---
+SNAPSHOT_CODED = ("state", "market", "commodity")   # int32 codes + <name>_dict.npy string dictionaries
+SNAPSHOT_VALUES = ("price", "day", "commodity_id", "market_id")
+
+_snapshot = None
+_snapshot_key = None
+_snapshot_build_lock = threading.Lock()
+
+def day_number(iso_date):
+    """Days since 1970-01-01 for an ISO date string (same scale as DAY_NUMBER_SQL)."""
+    return (pd.Timestamp(iso_date) - pd.Timestamp("1970-01-01")).days
+
+def _data_version():
+    """Identity of the data the snapshot was cut from: latest finished run, its finish time and schema version.
+
+    Stored in meta.json instead of a file path, so a snapshot stays valid wherever the DB is checked
+    out and goes stale as soon as the updater runs again or a migration rewrites ids.
+    """
+    conn = get_connection()
+    row = conn.execute("SELECT run_id, finished_at FROM update_runs WHERE finished_at IS NOT NULL ORDER BY run_id DESC LIMIT 1").fetchone()
+    run_id, finished_at = row if row else (0, None)
+    return {"data_version": run_id, "run_finished_at": finished_at,
+            "schema_version": conn.execute("PRAGMA user_version").fetchone()[0]}
+
+def _read_snapshot_meta(path):
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _snapshot_current(meta):
+    return meta is not None and all(meta.get(k) == v for k, v in _data_version().items())
+
+@agro_metrics.timed("export_snapshot")
+def export_snapshot(path=None):
+    """Writes mandi_prices as a columnar snapshot: dictionary-encoded names plus price/day arrays (.npy).
+
+    Readers memory-map it with load_snapshot. Plain .npy files are used instead of an .npz
+    archive because NumPy cannot memory-map members of a zip.
+    """
+    path = path or SNAPSHOT_DIR
+    conn = get_connection()
+    version = _data_version()
+    df = pd.read_sql_query(f"SELECT state, market, commodity, modal_price, {DAY_NUMBER_SQL.format(col='arrival_date')} AS day, commodity_id, market_id FROM mandi_prices", conn)
+
+    tmp = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for col in SNAPSHOT_CODED:
+        codes, names = pd.factorize(df[col], sort=True)
+        np.save(os.path.join(tmp, f"{col}.npy"), codes.astype(np.int32))
+        np.save(os.path.join(tmp, f"{col}_dict.npy"), np.asarray(names, dtype=str))
+    np.save(os.path.join(tmp, "price.npy"), df['modal_price'].to_numpy(dtype=np.float64))
+    np.save(os.path.join(tmp, "day.npy"), df['day'].to_numpy(dtype=np.int32))
+    np.save(os.path.join(tmp, "commodity_id.npy"), df['commodity_id'].to_numpy(dtype=np.int32))
+    np.save(os.path.join(tmp, "market_id.npy"), df['market_id'].to_numpy(dtype=np.int32))
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump({**version, "rows": len(df), "written_at": time.strftime("%Y-%m-%dT%H:%M:%S")}, f)
+
+    # Swap directories so readers never see a half-written snapshot
+    old = f"{path}.old"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    print(f"🗃️ Columnar snapshot written ({len(df)} rows) to {path}/")
+
+def load_snapshot(path=None):
+    """Memory-maps the columnar snapshot of mandi_prices, rebuilding it first if it is missing or stale.
+
+    Arrays are plain .npy files opened with mmap_mode='r', so loading is zero-copy and only the
+    pages a query touches are read. The snapshot is not committed with the DB, so the first reader
+    after each updater run cuts a fresh one (SNAPSHOT_AUTO_BUILD). Returns None when that is
+    switched off or the directory is not writable; callers then query SQLite.
+    """
+    global _snapshot, _snapshot_key
+    path = path or SNAPSHOT_DIR
+    meta = _read_snapshot_meta(path)
+    if not _snapshot_current(meta):
+        if not SNAPSHOT_AUTO_BUILD:
+            return None
+        with _snapshot_build_lock:
+            meta = _read_snapshot_meta(path)   # another thread may have rebuilt it meanwhile
+            if not _snapshot_current(meta):
+                try:
+                    export_snapshot(path)
+                except OSError as e:
+                    agro_metrics.error("snapshot_rebuild", e)
+                    print(f"⚠️ Could not rebuild the snapshot in {path}/: {e}")
+                    return None
+                meta = _read_snapshot_meta(path)
+        if not _snapshot_current(meta):
+            return None
+
+    key = (os.path.abspath(path), meta["data_version"], meta["written_at"])
+    if _snapshot_key != key:
+        names = [*SNAPSHOT_CODED, *(f"{c}_dict" for c in SNAPSHOT_CODED), *SNAPSHOT_VALUES]
+        try:
+            _snapshot = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in names}
+        except OSError:
+            # Written by an older updater without every column; SQLite serves until the next export
+            return None
+        _snapshot_key = key
+    return _snapshot
+
+def _snapshot_rows(snap, commodity_ids=None, states=None, day=None):
+    """Row positions in the snapshot matching a list of commodity ids, a state list and/or a day number."""
+    keep = np.ones(len(snap["price"]), dtype=bool)
+    if commodity_ids is not None:
+        keep &= np.isin(snap["commodity_id"], commodity_ids)
+    if states:
+        keep &= np.isin(snap["state"], np.nonzero(np.isin(snap["state_dict"], list(states)))[0])
+    if day is not None:
+        keep &= snap["day"] == day
+    return np.nonzero(keep)[0]
+
+PRICE_COLUMNS = ['crop', 'variety', 'commodity_id', 'state', 'market', 'modal_price', 'arrival_date']
+
+def _market_prices_from_snapshot(snap, crop_ids, states, arrival_date):
+    day = day_number(arrival_date) if arrival_date else None
+    frames = []
+    for crop, commodity_id in crop_ids:
+        rows = _snapshot_rows(snap, [commodity_id], states, day)
+        # Newest first, then the first row per market (same as ORDER BY arrival_date DESC + drop_duplicates)
+        rows = rows[np.argsort(-snap["day"][rows], kind="stable")]
+        _, first = np.unique(snap["market"][rows], return_index=True)
+        rows = rows[np.sort(first)]
+        frames.append(pd.DataFrame({
+            "crop": crop,
+            "commodity_id": commodity_id,
+            "state": snap["state_dict"][snap["state"][rows]].astype(object),
+            "market": snap["market_dict"][snap["market"][rows]].astype(object),
+            "modal_price": np.asarray(snap["price"][rows]),
+            "arrival_date": pd.to_datetime(np.asarray(snap["day"][rows]), unit="D").strftime("%Y-%m-%d").to_numpy(dtype=object),
+        }))
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=PRICE_COLUMNS)
+
+@agro_metrics.timed("load_market_prices")
+def load_market_prices(commodities, states=None, arrival_date=None):
+    """Latest modal price (and its arrival_date) per (crop, variety, market) for every commodity query, in one pass.
+
+    Each commodity query resolves to one or more variety ids through the alias table (case-insensitive,
+    feed variety suffixes and COMMODITY_SYNONYMS included); unknown names return no rows. Rows keep
+    their commodity_id and variety name so callers only compare prices of the same variety.
+    With `arrival_date`, only that day's prices are used. Served from the memory-mapped snapshot
+    when it is current, otherwise from SQLite.
+    """
+    crop_ids = [(crop, cid) for crop in commodities for cid in resolve_commodity(crop)]
+    if not crop_ids:
+        return pd.DataFrame(columns=PRICE_COLUMNS)
+    varieties = commodity_names({cid for _, cid in crop_ids})
+
+    snap = load_snapshot()
+    agro_metrics.count("prices.from_snapshot" if snap is not None else "prices.from_sqlite")
+    if snap is not None:
+        df = _market_prices_from_snapshot(snap, crop_ids, states, arrival_date)
+        return df.assign(variety=df['commodity_id'].map(varieties))[PRICE_COLUMNS]
+
+    ids = sorted(varieties)
+    query = f"SELECT commodity_id, state, market, modal_price, arrival_date FROM mandi_prices WHERE commodity_id IN ({', '.join(['?'] * len(ids))})"
+    params = list(ids)
+    if states:
+        query += f" AND state IN ({', '.join(['?'] * len(states))})"
+        params += list(states)
+    if arrival_date:
+        query += " AND arrival_date = ?"
+        params.append(arrival_date)
+    df = pd.read_sql_query(query + " ORDER BY arrival_date DESC", get_connection(), params=params)
+
+    frames = [df[df['commodity_id'] == cid].drop_duplicates(subset=['market']).assign(crop=crop, variety=varieties[cid])
+              for crop, cid in crop_ids]
+    return pd.concat(frames, ignore_index=True)[PRICE_COLUMNS]
+
 def fetch_trusted_data(commodity_query):
     try:
-        conn = sqlite3.connect(DB_NAME)
-        placeholders = ', '.join(['?'] * len(TRUSTED_STATES))
-        query = f"SELECT market, modal_price FROM mandi_prices WHERE commodity LIKE ? AND state IN ({placeholders}) ORDER BY arrival_date DESC"
-        params = [f'%{commodity_query}%'] + TRUSTED_STATES
-        df = pd.read_sql_query(query, conn, params=params).drop_duplicates(subset=['market'])
-        conn.close()
-        return df.to_dict('records')
+        df = load_market_prices([commodity_query], TRUSTED_STATES)
+        return df[['market', 'variety', 'modal_price']].to_dict('records')
     except Exception as e:
+        agro_metrics.error("fetch_trusted_data", e)
+        print(f"Price lookup error for {commodity_query}: {e}")
         return []
 
+# --- COST MODEL ---
+PROFIT_FIELDS = ("net_profit", "gross_profit", "wastage_loss", "fees_and_labor", "freight")
+
+class CostModel:
+    """Truckload cost model with per-crop constants precomputed from CROP_PROFILES.
+
+    Every method takes NumPy-broadcastable (distance, buy, sell) inputs and returns the
+    PROFIT_FIELDS breakdown as arrays of the broadcast shape. Build one through cost_model().
+    """
+
+    def __init__(self, truck=DEFAULT_TRUCK, freight_bands=FREIGHT_BANDS, tax=MANDI_TAX, profiles=None):
+        tier = TRUCK_TIERS[truck]
+        self.truck = truck
+        self.capacity = float(tier["capacity"])
+        self.freight_rate = float(tier["rate"])
+        self.tax = tax
+
+        starts, multipliers = (np.asarray(col, dtype=float) for col in zip(*sorted(freight_bands)))
+        if starts[0] != 0 or (multipliers < 0).any():
+            raise ValueError("freight bands must start at 0 km and use non-negative multipliers")
+        self._band_start = starts
+        self._band_mult = multipliers
+        # Rate-weighted km already charged when a trip reaches the start of each band
+        self._band_base = np.concatenate(([0.0], np.cumsum(np.diff(starts) * multipliers[:-1])))
+
+        profiles = profiles or CROP_PROFILES
+        self._crops = {name: i for i, name in enumerate(profiles)}
+        self._default = self._crops["default"]
+        self._wastage = np.array([p["wastage"] for p in profiles.values()])
+        self._labor = np.array([p["labor"] for p in profiles.values()], dtype=float)
+        self._profile_index = {}
+
+    def _profile(self, commodity):
+        i = self._profile_index.get(commodity)
+        if i is None:
+            # Feed varieties and spellings ("Paddy(Dhan)(Common)", "Soyabean", "dhan") use their base crop's profile
+            key = commodity_key(commodity)
+            names = (key, COMMODITY_SYNONYMS.get(key), *(term for term, target in COMMODITY_SYNONYMS.items() if target == key))
+            i = next((self._crops[n] for n in names if n in self._crops), self._default)
+            self._profile_index[commodity] = i
+        return self._wastage[i], self._labor[i]
+
+    def charged_km(self, distances):
+        """Distance after the freight bands are applied (equal to the distance with one flat band)."""
+        dist = np.asarray(distances, dtype=float)
+        band = np.clip(np.searchsorted(self._band_start, dist, side="right") - 1, 0, len(self._band_start) - 1)
+        return self._band_base[band] + (dist - self._band_start[band]) * self._band_mult[band]
+
+    def _breakdown(self, commodity, distances, buy, sell, rate, tax, labor):
+        wastage, crop_labor = self._profile(commodity)
+        labor = crop_labor if labor is None else labor
+        buy = np.asarray(buy, dtype=float)
+        sell = np.asarray(sell, dtype=float)
+
+        total_buy_cost = buy * self.capacity
+        total_sell_revenue = sell * (self.capacity * (1 - wastage))
+        freight_cost = self.charged_km(distances) * rate
+        total_labor = labor * self.capacity
+        mandi_fees = (total_buy_cost + total_sell_revenue) * tax
+        fields = {
+            "net_profit": total_sell_revenue - total_buy_cost - freight_cost - total_labor - mandi_fees,
+            "gross_profit": (sell - buy) * self.capacity - freight_cost,
+            "wastage_loss": (self.capacity * wastage) * sell,
+            "fees_and_labor": total_labor + mandi_fees,
+            "freight": freight_cost,
+        }
+        shape = np.broadcast_shapes(*(np.shape(v) for v in fields.values()))
+        return {k: np.broadcast_to(v, shape) for k, v in fields.items()}
+
+    def evaluate(self, commodity, distances, buy_prices, sell_prices, custom_freight=None, custom_tax=None, custom_labor=None):
+        """Breakdown for every (distance, buy, sell) combination; None overrides fall back to the model defaults."""
+        rate = self.freight_rate if custom_freight is None else custom_freight
+        tax = self.tax if custom_tax is None else custom_tax
+        return self._breakdown(commodity, distances, buy_prices, sell_prices, rate, tax, custom_labor)
+
+    def sweep(self, commodity, distances, buy_prices, sell_prices, freight_rates, tax_rates, custom_labor=None):
+        """Evaluates every freight rate x tax rate pair in one pass.
+
+        Results have shape (len(freight_rates), len(tax_rates), *inputs_shape).
+        """
+        extra = np.broadcast_shapes(np.shape(distances), np.shape(buy_prices), np.shape(sell_prices))
+        rate = np.asarray(freight_rates, dtype=float).reshape((-1, 1) + (1,) * len(extra))
+        tax = np.asarray(tax_rates, dtype=float).reshape((1, -1) + (1,) * len(extra))
+        return self._breakdown(commodity, distances, buy_prices, sell_prices, rate, tax, custom_labor)
+
+_cost_models = {}
+
+def cost_model(truck=None):
+    """Shared CostModel per truck tier, built from the current configuration on first use."""
+    truck = truck or DEFAULT_TRUCK
+    if truck not in _cost_models:
+        _cost_models[truck] = CostModel(truck)
+    return _cost_models[truck]
+
 def calculate_real_profit(commodity, distance_km, buy_price_qtl, sell_price_qtl, custom_freight=None, custom_tax=None, custom_labor=None):
-    profile = CROP_PROFILES.get(commodity.lower(), CROP_PROFILES["default"])
-    freight_rate = custom_freight if custom_freight is not None else 35
-    tax_rate = custom_tax if custom_tax is not None else 0.03
-    labor_rate = custom_labor if custom_labor is not None else profile["labor"]
-    truck_capacity_qtl = 100  
-    sellable_qty = truck_capacity_qtl * (1 - profile["wastage"]) 
-    total_buy_cost = buy_price_qtl * truck_capacity_qtl
-    total_sell_revenue = sell_price_qtl * sellable_qty
-    freight_cost = distance_km * freight_rate
-    total_labor = labor_rate * truck_capacity_qtl
-    mandi_fees = (total_buy_cost + total_sell_revenue) * tax_rate
-    net_profit = total_sell_revenue - total_buy_cost - freight_cost - total_labor - mandi_fees
-    
-    return {
-        "net_profit": net_profit, "gross_profit": (sell_price_qtl - buy_price_qtl) * truck_capacity_qtl - freight_cost,
-        "wastage_loss": (truck_capacity_qtl * profile["wastage"]) * sell_price_qtl,
-        "fees_and_labor": total_labor + mandi_fees, "freight": freight_cost
-    }
+    """Profit breakdown for one truckload; use compute_profit_matrix or CostModel.evaluate for many routes."""
+    fin = cost_model().evaluate(commodity, distance_km, buy_price_qtl, sell_price_qtl, custom_freight, custom_tax, custom_labor)
+    return {k: v.item() if v.ndim == 0 else v for k, v in fin.items()}
+
+def compute_profit_matrix(commodity, buy_prices, sell_prices, distances, max_distance=None, min_profit=None,
+                          custom_freight=None, custom_tax=None, custom_labor=None, model=None):
+    """Vectorized calculate_real_profit for every origin (row) x destination (column) pair at once.
+
+    `distances` is an (n_origins, n_destinations) array with NaN for unknown routes.
+    Returns the same breakdown as calculate_real_profit as 2-D arrays, plus a boolean
+    `viable` mask that applies the distance cap and the min_profit filter in the same pass.
+    `model` picks a CostModel (truck tier); the default is cost_model().
+    """
+    model = model or cost_model()
+    dist = np.asarray(distances, dtype=float)
+    fin = model.evaluate(commodity, dist, np.asarray(buy_prices, dtype=float)[:, None],
+                         np.asarray(sell_prices, dtype=float)[None, :], custom_freight, custom_tax, custom_labor)
+
+    # NaN distances compare False, so unknown routes drop out of the mask automatically
+    viable = dist > 0
+    if max_distance is not None:
+        viable &= dist <= max_distance
+    if min_profit is not None:
+        viable &= fin["net_profit"] >= min_profit
+    return {**fin, "viable": viable}
+
+def _fetch_table_chunk(origins, destinations):
+    """One OSRM /table call for a block of (clean_name, coords) origins x destinations; None if the call failed."""
+    points = origins + destinations
+    coords = ";".join(f"{c[1]},{c[0]}" for _, c in points)
+    sources = ";".join(str(i) for i in range(len(origins)))
+    dests = ";".join(str(i) for i in range(len(origins), len(points)))
+    try:
+        res = _osrm_get(f"/table/v1/driving/{coords}?sources={sources}&destinations={dests}&annotations=distance")
+    except Exception as e:
+        agro_metrics.error("osrm.table", e)
+        print(f"OSRM table error: {e}")
+        return None
+    if res.get('code') != 'Ok':
+        agro_metrics.count("osrm.table_not_ok")
+        return None
+
+    found = []
+    for i, row in enumerate(res['distances']):
+        for j, meters in enumerate(row):
+            if meters is not None and origins[i][0] != destinations[j][0]:
+                found.append((origins[i][0], destinations[j][0], meters / 1000.0))
+    return found
+
+@agro_metrics.timed("prefetch_routes")
+def prefetch_routes(origin_names, destination_names=None, pairs=None, failed=None):
+    """Resolves every uncached (origin, destination) driving distance in bulk via the OSRM table service.
+
+    Looks up all origin x destination pairs, or only the given `pairs` of (origin, destination) names.
+    Missing pairs are grouped into OSRM_TABLE_CHUNK x OSRM_TABLE_CHUNK blocks that run on a bounded
+    thread pool, and all results are written back to route_cache in one transaction.
+    Returns {(clean_origin, clean_destination): distance_km} for every requested pair that is now known.
+    Pairs whose OSRM call failed (as opposed to having no road route) are added to the `failed` set if given.
+    """
+    raw_names = {}
+    if pairs is not None:
+        wanted = set()
+        for o, d in pairs:
+            co, cd = clean_market_name(o), clean_market_name(d)
+            raw_names.setdefault(co, o)
+            raw_names.setdefault(cd, d)
+            if co != cd: wanted.add((co, cd))
+    else:
+        if destination_names is None:
+            destination_names = origin_names
+        origins = {clean_market_name(n): n for n in origin_names}
+        destinations = {clean_market_name(n): n for n in destination_names}
+        raw_names = {**destinations, **origins}
+        wanted = {(o, d) for o in origins for d in destinations if o != d}
+
+    conn = get_connection()
+    known = {}
+    origin_keys = sorted({o for o, _ in wanted})
+    for a in range(0, len(origin_keys), 500):
+        block = origin_keys[a:a + 500]
+        query = f"SELECT origin, destination, distance_km FROM route_cache WHERE origin IN ({', '.join(['?'] * len(block))})"
+        for o, d, km in conn.execute(query, block):
+            if (o, d) in wanted:
+                known[(o, d)] = km
+
+    missing = wanted - known.keys()
+    agro_metrics.cache_lookup("route_cache", True, len(known))
+    agro_metrics.cache_lookup("route_cache", False, len(missing))
+    if not missing:
+        return known
+
+    # Geocode only the markets that take part in a missing pair
+    coords = {}
+    for name in {o for o, _ in missing} | {d for _, d in missing}:
+        c = get_coordinates(raw_names[name])
+        if c: coords[name] = c
+    missing = {(o, d) for o, d in missing if o in coords and d in coords}
+
+    # Sorting by position keeps neighbouring markets in the same block, so sparse pair sets need fewer calls
+    src = sorted({o for o, _ in missing}, key=lambda n: coords[n])
+    dst = sorted({d for _, d in missing}, key=lambda n: coords[n])
+    chunks = []
+    for a in range(0, len(src), OSRM_TABLE_CHUNK):
+        for b in range(0, len(dst), OSRM_TABLE_CHUNK):
+            block_src = src[a:a + OSRM_TABLE_CHUNK]
+            block_dst = dst[b:b + OSRM_TABLE_CHUNK]
+            if any((o, d) in missing for o in block_src for d in block_dst):
+                chunks.append(([(n, coords[n]) for n in block_src], [(n, coords[n]) for n in block_dst]))
+
+    with ThreadPoolExecutor(max_workers=OSRM_WORKERS) as pool:
+        fetched = list(pool.map(lambda c: _fetch_table_chunk(*c), chunks))
+    results = [row for rows in fetched if rows for row in rows]
+    if failed is not None:
+        for (block_src, block_dst), rows in zip(chunks, fetched):
+            if rows is None:
+                failed.update((o, d) for o, _ in block_src for d, _ in block_dst if (o, d) in missing)
+
+    if results:
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO route_cache (origin, destination, distance_km) VALUES (?, ?, ?)", results)
+            # Mirror the reverse direction like get_driving_distance does, without overwriting real values
+            conn.executemany("INSERT OR IGNORE INTO route_cache (origin, destination, distance_km) VALUES (?, ?, ?)",
+                             [(d, o, km) for o, d, km in results])
+
+    for o, d, km in results:
+        if (o, d) in wanted:
+            known[(o, d)] = km
+        if (d, o) in wanted and (d, o) not in known:
+            known[(d, o)] = km
+    return known
+
+def _fill_distance_matrix(market_names, index_pairs, routes):
+    matrix = np.full((len(market_names), len(market_names)), np.nan)
+    clean = [clean_market_name(name) for name in market_names]
+    for i, j in index_pairs:
+        if (clean[i], clean[j]) in routes:
+            matrix[i, j] = routes[(clean[i], clean[j])]
+    return matrix
+
+# --- SPATIAL PRE-FILTER ---
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km; accepts scalars or broadcastable NumPy arrays."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+def _grid_cell(lat, lon, cell_deg):
+    return (math.floor(lat / cell_deg), math.floor(lon / cell_deg))
+
+def build_spatial_grid(coords, cell_deg=GRID_CELL_DEG):
+    """Buckets point positions into lat/lon cells: {(row, col): [index, ...]}. None coords are skipped."""
+    grid = {}
+    for i, c in enumerate(coords):
+        if c:
+            grid.setdefault(_grid_cell(c[0], c[1], cell_deg), []).append(i)
+    return grid
+
+def grid_neighbours(grid, lat, lon, radius_km, cell_deg=GRID_CELL_DEG):
+    """Indices in every grid cell that could hold a point within radius_km of (lat, lon)."""
+    dlat = radius_km / 111.0
+    # Longitude degrees shrink towards the poles; size the window for the worst latitude it covers
+    dlon = radius_km / (111.0 * max(math.cos(math.radians(min(abs(lat) + dlat, 89.0))), 0.01))
+    r0, c0 = _grid_cell(lat - dlat, lon - dlon, cell_deg)
+    r1, c1 = _grid_cell(lat + dlat, lon + dlon, cell_deg)
+    found = []
+    for r in range(r0, r1 + 1):
+        for c in range(c0, c1 + 1):
+            found.extend(grid.get((r, c), ()))
+    return found
+
+def great_circle_candidates(market_names, max_distance):
+    """(n, n) great-circle km for pairs that could be within max_distance by road, NaN for everything else.
+
+    Uses the spatial grid, so each market is only compared with markets in nearby cells.
+    """
+    n = len(market_names)
+    matrix = np.full((n, n), np.nan)
+    coords = [get_coordinates(name) for name in market_names]
+    grid = build_spatial_grid(coords)
+    lat = np.array([c[0] if c else np.nan for c in coords])
+    lon = np.array([c[1] if c else np.nan for c in coords])
+    radius = max_distance / ROAD_FACTOR_MIN
+
+    for i, c in enumerate(coords):
+        if not c: continue
+        near = np.array([j for j in grid_neighbours(grid, c[0], c[1], radius) if j != i], dtype=int)
+        if not len(near): continue
+        gc = haversine_km(c[0], c[1], lat[near], lon[near])
+        keep = gc <= radius
+        matrix[i, near[keep]] = gc[keep]
+    return matrix
+
+def great_circle_index(market_names, max_distance):
+    """great_circle_candidates for a set of markets, as ({name: row}, matrix) that plan_routes can slice.
+
+    Lets callers that plan many overlapping subsets (regions) of one crop's markets pay for the
+    spatial search once.
+    """
+    names = list(dict.fromkeys(market_names))
+    return {name: i for i, name in enumerate(names)}, great_circle_candidates(names, max_distance)
+
+# --- ROUTE SEARCH API ---
+@agro_metrics.timed("plan_routes")
+def plan_routes(prices, origins=None, destinations=None, max_distance=400, min_profit=0,
+                custom_freight=None, custom_tax=None, custom_labor=None, candidates=None):
+    """First half of a route search: per crop variety, prunes pairs on straight-line distance and best-case profit.
+
+    `prices` is a load_market_prices frame; buy and sell prices are only paired within one commodity_id.
+    Returns (plans, pairs); `pairs` are the (origin, destination) market names that still need a
+    driving distance, ready for one shared prefetch_routes call. `candidates` is an optional
+    great_circle_index over (at least) these markets, computed with the same max_distance.
+    """
+    costs = dict(custom_freight=custom_freight, custom_tax=custom_tax, custom_labor=custom_labor)
+    buy_at = {clean_market_name(n).lower() for n in origins} if origins else None
+    sell_at = {clean_market_name(n).lower() for n in destinations} if destinations else None
+
+    plans, pairs = [], []
+    for (crop, commodity_id), df in prices.groupby(['crop', 'commodity_id'], sort=False):
+        names = df['market'].tolist()
+        keys = [clean_market_name(n).lower() for n in names]
+        rows = np.array([buy_at is None or k in buy_at for k in keys])
+        cols = np.array([sell_at is None or k in sell_at for k in keys])
+        if len(names) < 2 or not rows.any() or not cols.any():
+            continue
+
+        price = df['modal_price'].to_numpy(dtype=float)
+        if candidates is None:
+            gc = great_circle_candidates(names, max_distance)
+        else:
+            at = [candidates[0][n] for n in names]
+            gc = candidates[1][np.ix_(at, at)]
+        gc[~rows, :] = np.nan
+        gc[:, ~cols] = np.nan
+        bound = compute_profit_matrix(crop, price, price, gc * ROAD_FACTOR_MIN, max_distance, min_profit, **costs)['viable']
+        index_pairs = list(zip(*np.nonzero(bound)))
+        pairs.extend((names[i], names[j]) for i, j in index_pairs)
+        plans.append(((crop, commodity_id, df['variety'].iat[0]), df['state'].tolist(), names, price, index_pairs))
+    return plans, pairs
+
+@agro_metrics.timed("rank_routes")
+def rank_routes(plans, routes, top_k=10, max_distance=400, min_profit=0,
+                custom_freight=None, custom_tax=None, custom_labor=None):
+    """Second half of a route search: exact profits for planned pairs, best first.
+
+    `routes` is a prefetch_routes result. At most top_k routes per crop are kept before the
+    cross-crop heap merge; top_k=None returns every viable route.
+    """
+    costs = dict(custom_freight=custom_freight, custom_tax=custom_tax, custom_labor=custom_labor)
+    found = []
+    for (crop, commodity_id, variety), states, names, price, index_pairs in plans:
+        dist = _fill_distance_matrix(names, index_pairs, routes)
+        fin = compute_profit_matrix(crop, price, price, dist, max_distance, min_profit, **costs)
+        ii, jj = np.nonzero(fin['viable'])
+        if top_k is not None and len(ii) > top_k:
+            best = np.argpartition(fin['net_profit'][ii, jj], -top_k)[-top_k:]
+            ii, jj = ii[best], jj[best]
+        for i, j in zip(ii, jj):
+            details = {k: float(fin[k][i, j]) for k in PROFIT_FIELDS}
+            found.append({
+                "crop": crop, "variety": variety, "commodity_id": commodity_id,
+                "from": names[i], "to": names[j], "from_state": states[i], "to_state": states[j],
+                "buy_price": float(price[i]), "sell_price": float(price[j]), "dist": float(dist[i, j]),
+                "profit": details["net_profit"], "details": details
+            })
+
+    if top_k is None:
+        return sorted(found, key=lambda r: r['profit'], reverse=True)
+    return heapq.nlargest(top_k, found, key=lambda r: r['profit'])
+
+def find_routes(commodities, origins=None, destinations=None, states=None, top_k=10, max_distance=400, min_profit=0,
+                arrival_date=None, custom_freight=None, custom_tax=None, custom_labor=None):
+    """Ranks buy-here/sell-there routes across commodities, best net profit first.
+
+    `origins` / `destinations` limit where to buy / sell (market names, None = anywhere), so passing
+    only destinations answers "where should I buy to sell at X". Prices for every commodity come from
+    one query and all missing routes from one prefetch. Only the top_k routes are ever sorted
+    (heap selection); top_k=None returns every viable route. min_profit=None keeps every route
+    within max_distance.
+    """
+    costs = dict(custom_freight=custom_freight, custom_tax=custom_tax, custom_labor=custom_labor)
+    # Default-cost searches the post-ingest table already covers are one indexed query
+    if (states and max_distance <= DEALS_MAX_KM and min_profit is not None and min_profit >= DEALS_MIN_PROFIT
+            and all(v is None for v in costs.values()) and daily_deals_ready(commodities, states)):
+        agro_metrics.count("routes.from_daily_deals")
+        return query_daily_deals(commodities, origins, destinations, states, top_k, max_distance, min_profit, arrival_date)
+
+    prices = load_market_prices(commodities, states, arrival_date)
+    plans, pairs = plan_routes(prices, origins, destinations, max_distance, min_profit, **costs)
+    routes = prefetch_routes(None, pairs=pairs) if pairs else {}
+    return rank_routes(plans, routes, top_k, max_distance, min_profit, **costs)
+
+def get_latest_run_id():
+    """Id of the most recent finished db_updater run (0 if the updater has never run)."""
+    row = get_connection().execute("SELECT MAX(run_id) FROM update_runs WHERE finished_at IS NOT NULL").fetchone()
+    return row[0] or 0
+
+# --- MATERIALIZED DAILY DEALS ---
+def _deal_rows(prices, plans, routes, max_distance):
+    dates = {(c, m): d for c, m, d in zip(prices['commodity_id'], prices['market'], prices['arrival_date'])}
+    market_ids = {m: resolve_market(m) for m in prices['market'].unique()}
+    rows = []
+    for r in rank_routes(plans, routes, top_k=None, max_distance=max_distance, min_profit=DEALS_MIN_PROFIT):
+        cid = r['commodity_id']
+        rows.append((cid, r['from'], r['to'], market_ids[r['from']], market_ids[r['to']],
+                     r['from_state'], r['to_state'], dates[(cid, r['from'])], dates[(cid, r['to'])],
+                     r['buy_price'], r['sell_price'], r['dist'], *(r['details'][k] for k in PROFIT_FIELDS)))
+    return rows
+
+@agro_metrics.timed("build_daily_deals")
+def build_daily_deals(crops=None, states=None, max_distance=DEALS_MAX_KM):
+    """Materializes every route within max_distance between markets of `states` that clears DEALS_MIN_PROFIT
+    at default costs into daily_deals, one commodity_id (variety) at a time.
+
+    A variety is rebuilt in full when the latest arrival date moved or its states changed; otherwise
+    only routes that start or end at a market whose price changed since the last build are
+    recomputed. Varieties with a planned pair whose OSRM call failed are written but left uncovered.
+    Returns the number of routes written.
+    """
+    crops = crops or DEAL_CROPS
+    states = sorted(states or DEAL_STATES)
+    conn = get_connection()
+    latest = conn.execute("SELECT MAX(arrival_date) FROM mandi_prices").fetchone()[0]
+    if not latest:
+        return 0
+    run_id = get_latest_run_id()
+    crop_of = {cid: crop for crop in crops for cid in resolve_commodity(crop)}
+    ids = sorted(crop_of)
+
+    full, partial = [], {}
+    for cid in ids:
+        cov = conn.execute("SELECT state, run_id, arrival_date FROM daily_deals_coverage WHERE commodity_id = ?", (cid,)).fetchall()
+        if {s for s, _, _ in cov} != set(states) or any(day != latest for _, _, day in cov):
+            full.append(cid)
+            continue
+        since = min(r for _, r, _ in cov)
+        if since >= run_id:
+            continue
+        partial[cid] = [m for (m,) in conn.execute(f"""
+            SELECT DISTINCT market FROM price_changes
+            WHERE run_id > ? AND state IN ({', '.join(['?'] * len(states))})
+              AND commodity IN (SELECT DISTINCT commodity FROM mandi_prices WHERE commodity_id = ?)
+        """, [since, *states, cid])]
+    if not full and not partial:
+        return 0
+
+    todo = [*full, *partial]
+    prices = load_market_prices(sorted({crop_of[cid] for cid in todo}), states)
+    prices = prices[prices['commodity_id'].isin(todo) & prices['commodity_id'].map(crop_of).eq(prices['crop'])]
+    plans, pairs = plan_routes(prices[prices['commodity_id'].isin(full)], max_distance=max_distance, min_profit=DEALS_MIN_PROFIT)
+    for cid, changed in partial.items():
+        part = prices[prices['commodity_id'] == cid]
+        for side in ({"origins": changed}, {"destinations": changed}) if changed else ():
+            crop_plans, crop_pairs = plan_routes(part, max_distance=max_distance, min_profit=DEALS_MIN_PROFIT, **side)
+            plans += crop_plans
+            pairs += crop_pairs
+    failed = set()
+    routes = prefetch_routes(None, pairs=pairs, failed=failed) if pairs else {}
+    # A variety is only marked current when every pair it planned got a driving distance
+    incomplete = {cid for (_, cid, _), _, names, _, index_pairs in plans
+                  if any((clean_market_name(names[i]), clean_market_name(names[j])) in failed for i, j in index_pairs)}
+    rows = _deal_rows(prices, plans, routes, max_distance)
+
+    with conn:
+        conn.executemany("DELETE FROM daily_deals WHERE commodity_id = ?", [(cid,) for cid in full])
+        conn.executemany("DELETE FROM daily_deals_coverage WHERE commodity_id = ?", [(cid,) for cid in full])
+        # Routes touching a repriced market may have dropped below the floor, so they are replaced rather than updated
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS changed_markets (market TEXT PRIMARY KEY)")
+        for cid, changed in partial.items():
+            conn.execute("DELETE FROM changed_markets")
+            conn.executemany("INSERT OR IGNORE INTO changed_markets (market) VALUES (?)", [(m,) for m in changed])
+            conn.execute("DELETE FROM daily_deals WHERE commodity_id = ? AND (origin IN changed_markets OR destination IN changed_markets)",
+                         (cid,))
+        conn.executemany(f"INSERT OR REPLACE INTO daily_deals VALUES ({', '.join(['?'] * 17)})", rows)
+        # Incomplete varieties lose their coverage, so readers route them live and the next build redoes them in full
+        conn.executemany("DELETE FROM daily_deals_coverage WHERE commodity_id = ?", [(cid,) for cid in incomplete])
+        conn.executemany("INSERT OR REPLACE INTO daily_deals_coverage (commodity_id, state, run_id, arrival_date) VALUES (?, ?, ?, ?)",
+                         [(cid, s, run_id, latest) for cid in todo if cid not in incomplete for s in states])
+    print(f"🧾 daily_deals: {len(full)} varieties rebuilt, {len(partial)} updated incrementally, {len(rows)} routes written.")
+    if incomplete:
+        print(f"⚠️ daily_deals: {len(incomplete)} varieties left uncovered because OSRM calls failed; they are routed live until the next build.")
+    return len(rows)
+
+def daily_deals_ready(crops, states):
+    """True when daily_deals is current (latest run and arrival date) for every variety of every crop x state asked for."""
+    # Names with no commodity id have no prices either, so they never need coverage
+    ids = {cid for crop in crops for cid in resolve_commodity(crop)}
+    states = set(states or ())
+    if not ids or not states:
+        return False
+    conn = get_connection()
+    latest = conn.execute("SELECT MAX(arrival_date) FROM mandi_prices").fetchone()[0]
+    covered = conn.execute(f"""
+        SELECT COUNT(*) FROM daily_deals_coverage
+        WHERE commodity_id IN ({', '.join(['?'] * len(ids))}) AND state IN ({', '.join(['?'] * len(states))})
+          AND run_id = ? AND arrival_date = ?
+    """, [*ids, *states, get_latest_run_id(), latest]).fetchone()[0]
+    return covered == len(ids) * len(states)
+
+def query_daily_deals(commodities, origins=None, destinations=None, states=None, top_k=10, max_distance=None,
+                      min_profit=None, arrival_date=None):
+    """find_routes results served from daily_deals with one indexed top-K query (default costs only).
+
+    With `arrival_date`, only routes whose buy and sell prices were both reported that day are returned.
+    """
+    crops = {cid: c for c in commodities for cid in resolve_commodity(c)}
+    if not crops:
+        return []
+    varieties = commodity_names(crops)
+
+    where, params = [f"commodity_id IN ({', '.join(['?'] * len(crops))})"], list(crops)
+    for column, names in (("origin_id", origins), ("destination_id", destinations)):
+        if names:
+            ids = {resolve_market(n) for n in names} - {None}
+            if not ids:
+                return []
+            where.append(f"{column} IN ({', '.join(['?'] * len(ids))})")
+            params += list(ids)
+    if states:
+        where.append(f"origin_state IN ({', '.join(['?'] * len(states))}) AND destination_state IN ({', '.join(['?'] * len(states))})")
+        params += [*states, *states]
+    if max_distance is not None:
+        where.append("distance_km <= ?")
+        params.append(max_distance)
+    if min_profit is not None:
+        where.append("net_profit >= ?")
+        params.append(min_profit)
+    if arrival_date:
+        where.append("origin_date = ? AND destination_date = ?")
+        params += [arrival_date, arrival_date]
+
+    query = f"""
+        SELECT commodity_id, origin, destination, origin_state, destination_state, buy_price, sell_price, distance_km,
+               {', '.join(PROFIT_FIELDS)}
+        FROM daily_deals WHERE {' AND '.join(where)} ORDER BY net_profit DESC
+    """
+    if top_k is not None:
+        query += " LIMIT ?"
+        params.append(top_k)
+
+    found = []
+    for cid, o, d, o_state, d_state, buy, sell, dist, *breakdown in get_connection().execute(query, params):
+        details = dict(zip(PROFIT_FIELDS, breakdown))
+        found.append({"crop": crops[cid], "variety": varieties[cid], "commodity_id": cid, "from": o, "to": d, "from_state": o_state, "to_state": d_state,
+                      "buy_price": buy, "sell_price": sell, "dist": dist, "profit": details["net_profit"], "details": details})
+    return found
+
+# --- PRICE HISTORY ANALYTICS ---
+def _empty_history(resolution):
+    return [], np.arange(0), np.empty((0, 0)), resolution
+
+def load_price_history(commodity, days=28, markets=None):
+    """Prices for a commodity query as (series, day_numbers, prices, resolution), prices shaped (n_series, n_points).
+
+    `commodity` resolves like in load_market_prices; every (market, variety) pair is its own series,
+    so varieties are never averaged together. Points a market did not report are NaN.
+    Windows up to HISTORY_DAILY_DAYS are daily points from price_history (resolution "daily").
+    Longer ones are weekly means (resolution "weekly", day_numbers = first day of each week) built
+    from price_history_weekly plus the not yet rolled-up daily rows, reaching back HISTORY_WEEKLY_WEEKS.
+    """
+    weekly = days > HISTORY_DAILY_DAYS
+    resolution = "weekly" if weekly else "daily"
+    ids = resolve_commodity(commodity)
+    if not ids:
+        return _empty_history(resolution)
+    conn = get_connection()
+    marks = ', '.join(['?'] * len(ids))
+    last_day = conn.execute(f"SELECT MAX(day) FROM price_history WHERE commodity_id IN ({marks})", ids).fetchone()[0]
+    if last_day is None and weekly:
+        last_week = conn.execute(f"SELECT MAX(week) FROM price_history_weekly WHERE commodity_id IN ({marks})", ids).fetchone()[0]
+        last_day = None if last_week is None else last_week * 7 + 6
+    if last_day is None:
+        return _empty_history(resolution)
+
+    if weekly:
+        # Weeks split cleanly between the two tables because the rollup cutoff is a week boundary
+        last, points = last_day // 7, -(-days // 7)
+        first = last - points + 1
+        rows = conn.execute(f"""
+            SELECT h.market, c.name, h.week, SUM(h.total) / SUM(h.n) FROM (
+                SELECT commodity_id, market, week, mean_price * samples AS total, samples AS n
+                FROM price_history_weekly WHERE commodity_id IN ({marks}) AND week >= ?
+                UNION ALL
+                SELECT commodity_id, market, day / 7, price, 1
+                FROM price_history WHERE commodity_id IN ({marks}) AND day >= ?
+            ) h JOIN commodities c ON c.commodity_id = h.commodity_id
+            GROUP BY h.commodity_id, h.market, h.week
+        """, [*ids, first, *ids, first * 7]).fetchall()
+        day_numbers = np.arange(first, last + 1) * 7
+    else:
+        last, points = last_day, days
+        first = last - points + 1
+        rows = conn.execute(f"""
+            SELECT h.market, c.name, h.day, AVG(h.price) FROM price_history h JOIN commodities c ON c.commodity_id = h.commodity_id
+            WHERE h.commodity_id IN ({marks}) AND h.day >= ? GROUP BY h.commodity_id, h.market, h.day
+        """, [*ids, first]).fetchall()
+        day_numbers = np.arange(first, last + 1)
+
+    if markets is not None:
+        wanted = {market_key(m) for m in markets}
+        rows = [r for r in rows if market_key(r[0]) in wanted]
+    series = sorted({(r[0], r[1]) for r in rows})
+    position = {key: i for i, key in enumerate(series)}
+
+    prices = np.full((len(series), points), np.nan)
+    for market, variety, point, price in rows:
+        prices[position[(market, variety)], point - first] = price
+    return series, day_numbers, prices, resolution
+
+def rolling_price_stats(commodity, window=7, days=28, markets=None):
+    """Per-market (and variety) rolling statistics over the last `window` days of history, as a DataFrame.
+
+    Columns: latest price, rolling mean and stddev, spread (max - min) inside the window, and the
+    least-squares trend in % of the mean per day (positive = prices rising). History longer than
+    HISTORY_DAILY_DAYS is read as weekly means, so `samples` then counts weeks.
+    """
+    series, _, prices, resolution = load_price_history(commodity, max(days, window), markets)
+    if not series:
+        return pd.DataFrame(columns=["market", "variety", "latest", "mean", "std", "spread", "trend_pct_per_day", "samples"])
+    step = 7 if resolution == "weekly" else 1
+    points = -(-window // step)   # window in days, rounded up to whole points
+
+    recent = prices[:, -points:]
+    seen = ~np.isnan(recent)
+    samples = seen.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # all-NaN rows are expected for quiet markets
+        mean = np.nanmean(recent, axis=1)
+        std = np.nanstd(recent, axis=1)
+        spread = np.nanmax(recent, axis=1) - np.nanmin(recent, axis=1)
+
+        # Masked least-squares slope for every market at once
+        x = np.broadcast_to(np.arange(recent.shape[1], dtype=float), recent.shape)
+        y = np.where(seen, recent, 0.0)
+        xs = np.where(seen, x, 0.0)
+        sx, sy = xs.sum(axis=1), y.sum(axis=1)
+        sxx, sxy = (xs * xs).sum(axis=1), (xs * y).sum(axis=1)
+        slope = (samples * sxy - sx * sy) / (samples * sxx - sx * sx)
+        trend = np.where(samples >= 2, slope / mean * 100 / step, np.nan)
+
+    last_seen = np.where(seen.any(axis=1), recent.shape[1] - 1 - np.argmax(seen[:, ::-1], axis=1), 0)
+    latest = np.where(samples > 0, recent[np.arange(len(series)), last_seen], np.nan)
+    return pd.DataFrame({"market": [m for m, _ in series], "variety": [v for _, v in series], "latest": latest, "mean": mean, "std": std, "spread": spread,
+                         "trend_pct_per_day": trend, "samples": samples})
+
 def analyze_state_volatility():
     """Finds the state and commodity with the most extreme price gap (Filtered for cash crops)."""
     try:
-        conn = sqlite3.connect(DB_NAME)
-        latest_date_str = pd.read_sql_query("SELECT MAX(arrival_date) FROM mandi_prices", conn).iloc[0, 0]
-        if not latest_date_str: return None
-
         # Filter for actual traded commodities, ignoring outlier flowers/spices
-        target_crops = "('Tomato', 'Soybean', 'Paddy', 'Wheat', 'Mustard', 'Cotton', 'Onion', 'Potato', 'Maize')"
+        target_crops = ['Tomato', 'Soybean', 'Paddy', 'Wheat', 'Mustard', 'Cotton', 'Onion', 'Potato', 'Maize']
+        target_ids = [cid for crop in target_crops for cid in resolve_commodity(crop)]
+        if not target_ids: return None
+
+        snap = load_snapshot()
+        if snap is not None and len(snap["day"]):
+            rows = _snapshot_rows(snap, target_ids, day=int(np.max(snap["day"])))
+            df = pd.DataFrame({
+                "state": snap["state_dict"][snap["state"][rows]].astype(object),
+                "commodity": snap["commodity_dict"][snap["commodity"][rows]].astype(object),
+                "modal_price": np.asarray(snap["price"][rows]),
+            })
+            gaps = df.groupby(["state", "commodity"], as_index=False)["modal_price"].agg(min_price="min", max_price="max")
+            gaps["price_gap"] = gaps["max_price"] - gaps["min_price"]
+            gaps = gaps[gaps["price_gap"] > 500].sort_values("price_gap", ascending=False)
+            return gaps.iloc[0].to_dict() if not gaps.empty else None
+
+        conn = get_connection()
+        latest_date_str = conn.execute("SELECT MAX(arrival_date) FROM mandi_prices").fetchone()[0]
+        if not latest_date_str: return None
         
         query = f"""
         SELECT state, commodity, 
@@ -147,17 +1460,17 @@ def analyze_state_volatility():
                MAX(modal_price) as max_price,
                (MAX(modal_price) - MIN(modal_price)) as price_gap
         FROM mandi_prices
-        WHERE arrival_date = '{latest_date_str}' AND commodity IN {target_crops}
+        WHERE arrival_date = ? AND commodity_id IN ({', '.join(['?'] * len(target_ids))})
         GROUP BY state, commodity
         HAVING price_gap > 500  
         ORDER BY price_gap DESC
         LIMIT 1
         """
-        df = pd.read_sql_query(query, conn)
-        conn.close()
-        
+        df = pd.read_sql_query(query, conn, params=[latest_date_str] + target_ids)
+
         if not df.empty:
             return df.iloc[0].to_dict()
     except Exception as e:
+        agro_metrics.error("analyze_state_volatility", e)
         print(f"Volatility Error: {e}")
     return None
@@ -0,0 +1,151 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# ==========================================
+# 📈 RUN INSTRUMENTATION
+# ==========================================
+# Off by default. Set AGRO_METRICS=1 to collect stage timings, cache hit ratios, external call
+# latency histograms and error counts; when off every hook returns immediately.
+ENABLED = os.environ.get("AGRO_METRICS", "") not in ("", "0")
+REPORT_FILE = os.environ.get("AGRO_METRICS_FILE", "run_report_{job}.json")
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+_lock = threading.Lock()
+_NOOP = nullcontext()
+_started = time.time()
+_stages = {}        # name -> [calls, total_s, max_s]
+_counters = {}      # name -> int
+_histograms = {}    # name -> [bucket counts..., total_s]
+_errors = {}        # name -> [count, last message]
+
+def enable(flag=True):
+    global ENABLED
+    ENABLED = flag
+
+def reset():
+    global _started
+    with _lock:
+        for table in (_stages, _counters, _histograms, _errors):
+            table.clear()
+        _started = time.time()
+
+@contextmanager
+def _timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            entry = _stages.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+
+def stage(name):
+    """Context manager timing one pipeline stage (SQLite, pandas, scan, delivery...)."""
+    return _timed_stage(name) if ENABLED else _NOOP
+
+def timed(name):
+    """Decorator form of stage() for functions that are a stage on their own."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with _timed_stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name, n=1):
+    if not ENABLED: return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def cache_lookup(cache, hit, n=1):
+    """Records n hits or misses against a named cache (location_cache, route_cache...)."""
+    if not ENABLED: return
+    count(f"cache.{cache}.{'hit' if hit else 'miss'}", n)
+
+def observe(name, seconds):
+    """Adds one latency sample to a histogram."""
+    if not ENABLED: return
+    with _lock:
+        hist = _histograms.setdefault(name, [0] * len(LATENCY_BUCKETS) + [0.0])
+        for i, upper in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper:
+                hist[i] += 1
+                break
+        hist[-1] += seconds
+
+def error(name, exc):
+    """Counts a handled exception and keeps the latest message, instead of swallowing it silently."""
+    if not ENABLED: return
+    with _lock:
+        entry = _errors.setdefault(name, [0, ""])
+        entry[0] += 1
+        entry[1] = f"{type(exc).__name__}: {exc}"
+
+@contextmanager
+def _timed_call(name):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        error(name, e)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def external(name):
+    """Context manager for one external call (Nominatim, OSRM, data.gov.in, Telegram): latency + errors."""
+    return _timed_call(name) if ENABLED else _NOOP
+
+def report():
+    """Snapshot of everything collected so far as a JSON-ready dict."""
+    with _lock:
+        caches = {}
+        for key, value in _counters.items():
+            if key.startswith("cache."):
+                _, cache, kind = key.split(".", 2)
+                caches.setdefault(cache, {"hit": 0, "miss": 0})[kind] = value
+        for stats in caches.values():
+            total = stats["hit"] + stats["miss"]
+            stats["hit_ratio"] = round(stats["hit"] / total, 4) if total else None
+
+        return {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(_started)),
+            "wall_s": round(time.time() - _started, 3),
+            "stages": {k: {"calls": c, "total_s": round(t, 4), "max_s": round(m, 4)} for k, (c, t, m) in _stages.items()},
+            "counters": {k: v for k, v in _counters.items() if not k.startswith("cache.")},
+            "caches": caches,
+            "external_calls": {
+                k: {"calls": sum(h[:-1]), "total_s": round(h[-1], 4),
+                    "buckets": {("inf" if b == float("inf") else str(b)): n for b, n in zip(LATENCY_BUCKETS, h[:-1])}}
+                for k, h in _histograms.items()
+            },
+            "errors": {k: {"count": c, "last": msg} for k, (c, msg) in _errors.items()},
+        }
+
+def write_report(job="run", path=None):
+    """Writes the run report as JSON and prints a one-line-per-stage summary. No-op when disabled."""
+    if not ENABLED: return None
+    data = report()
+    data["job"] = job
+    path = path or REPORT_FILE.format(job=job)
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
+    print(f"📈 Run report ({data['wall_s']}s) written to {path}")
+    for name, s in sorted(data["stages"].items(), key=lambda kv: -kv[1]["total_s"]):
+        print(f"   ⏱️ {name}: {s['total_s']}s over {s['calls']} call(s)")
+    for name, c in data["caches"].items():
+        print(f"   🗄️ {name}: {c['hit']} hits / {c['miss']} misses")
+    for name, e in data["errors"].items():
+        print(f"   ❌ {name}: {e['count']} error(s), last: {e['last']}")
+    return path
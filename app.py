@@ -1,7 +1,10 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
 import agro_core  
 
+MAX_ROUTE_KM = 400
+
 # --- STREAMLIT UI SETUP ---
 st.set_page_config(page_title="Agro Trader Pro", page_icon="🌾", layout="wide")
 
@@ -12,12 +15,24 @@ st.markdown("Find the most profitable agricultural arbitrage routes in real-time
 st.sidebar.header("Search Parameters")
 my_location = st.sidebar.text_input("Base City (e.g., Raigarh, Raipur)", value="Raigarh").strip()
 commodity = st.sidebar.text_input("Commodity (e.g., Tomato, Paddy)", value="Tomato").strip()
+
+# Unknown or misspelt names get "did you mean" choices from the trigram name index
+if commodity and not agro_core.resolve_commodity(commodity):
+    suggestions = [name for _, name in agro_core.search_names(commodity, "commodity")]
+    if suggestions:
+        commodity = st.sidebar.selectbox(f"Did you mean (for '{commodity}')?", suggestions)
+if my_location and agro_core.resolve_market(my_location) is None:
+    suggestions = [name for _, name in agro_core.search_names(my_location, "market")]
+    if suggestions:
+        my_location = st.sidebar.selectbox(f"Nearest market names (for '{my_location}')", [my_location, *suggestions])
 min_profit = st.sidebar.slider("Minimum True Net Profit (₹)", 1000, 50000, 5000, step=1000)
 
 # --- SIDEBAR: ADVANCED LOGISTICS (OVERRIDES) ---
 st.sidebar.markdown("---")
 with st.sidebar.expander("⚙️ Custom Logistics", expanded=False):
     st.caption("Leave as 0.0 to use system defaults based on crop type.")
+    truck = st.selectbox("Truck Size", list(agro_core.TRUCK_TIERS), index=list(agro_core.TRUCK_TIERS).index(agro_core.DEFAULT_TRUCK),
+                         format_func=lambda t: f"{t.title()} ({agro_core.TRUCK_TIERS[t]['capacity']} Qtl, ₹{agro_core.TRUCK_TIERS[t]['rate']}/km)")
     custom_freight = st.number_input("Custom Truck Rate (₹/km)", min_value=0.0, value=0.0, step=1.0)
     custom_tax = st.number_input("Custom Mandi Tax (%)", min_value=0.0, value=0.0, step=0.5)
     custom_labor = st.number_input("Custom Labor Rate (₹/Qtl)", min_value=0.0, value=0.0, step=1.0)
@@ -25,12 +40,35 @@ with st.sidebar.expander("⚙️ Custom Logistics", expanded=False):
 freight_val = custom_freight if custom_freight > 0 else None
 tax_val = (custom_tax / 100) if custom_tax > 0 else None
 labor_val = custom_labor if custom_labor > 0 else None
+model = agro_core.cost_model(truck)
+
+# --- CACHED DATA LAYERS ---
+# Snapshots are keyed by the updater's run id, so every db_updater write starts a fresh cache generation
+@st.cache_data(ttl=3600, max_entries=64, show_spinner=False)
+def load_market_snapshot(commodity, data_version):
+    return agro_core.fetch_trusted_data(commodity)
+
+@st.cache_data(ttl=6 * 3600, max_entries=256, show_spinner=False)
+def load_route_candidates(commodity, origin_market, data_version, min_profit=None):
+    """Routable markets within MAX_ROUTE_KM of origin_market, priced at default costs.
+
+    With a min_profit at or above DEALS_MIN_PROFIT these are read from the precomputed daily_deals
+    table; min_profit=None routes every candidate live so custom costs can re-price them.
+    """
+    return agro_core.find_routes([commodity], origins=[origin_market], states=agro_core.TRUSTED_STATES,
+                                 top_k=None, max_distance=MAX_ROUTE_KM, min_profit=min_profit)
 
 # --- MAIN EXECUTION ---
-if st.sidebar.button("Analyze Routes 🚀"):
+clicked = st.sidebar.button("Analyze Routes 🚀")
+if clicked:
+    st.session_state["analyze"] = True
+
+# Once analyzed, slider and cost changes re-filter the cached vectors instead of re-running the search
+if st.session_state.get("analyze"):
     with st.spinner("Querying database and calculating enterprise logistics..."):
         
-        markets = agro_core.fetch_trusted_data(commodity)
+        data_version = agro_core.get_latest_run_id()
+        markets = load_market_snapshot(commodity, data_version)
         
         if not markets:
             st.error(f"No reliable data found for '{commodity}'. Check your database or spelling.")
@@ -41,56 +79,47 @@ if st.sidebar.button("Analyze Routes 🚀"):
             st.error(f"Could not map '{my_location}'. Try a nearby larger city.")
             st.stop()
 
-        local_market = next((m for m in markets if my_location.lower() in m['market'].lower()), None)
+        base_key = agro_core.market_key(my_location)
+        local_market = next((m for m in markets if agro_core.market_key(m['market']) == base_key), None) \
+            or next((m for m in markets if my_location.lower() in m['market'].lower()), None)
         if not local_market:
             st.warning(f"No local prices for {my_location} in the database today. Showing all regional data instead.")
             st.dataframe(pd.DataFrame(markets))
             st.stop()
 
         local_price = local_market['modal_price']
-        st.success(f"**Local Buy Price in {local_market['market']}:** ₹{local_price}/Qtl")
+        st.success(f"**Local Buy Price in {local_market['market']}** ({local_market['variety']}): ₹{local_price}/Qtl")
         
-        opportunities = []
-        progress_bar = st.progress(0)
+        # Routing happens once per origin; cost overrides and the slider only re-price the cached routes
+        # Default costs can only keep routes that already profit at default costs, so those come from daily_deals
+        default_costs = freight_val is None and tax_val is None and labor_val is None and truck == agro_core.DEFAULT_TRUCK
+        routes = load_route_candidates(commodity, local_market['market'], data_version,
+                                       agro_core.DEALS_MIN_PROFIT if default_costs else None)
+        # Only sell the variety that is bought locally; other varieties' prices are not comparable
+        routes = [r for r in routes if r['variety'] == local_market['variety']]
+        distances = np.array([r['dist'] for r in routes], dtype=float)
+        sell_prices = np.array([r['sell_price'] for r in routes], dtype=float)
         
-        for i, m in enumerate(markets):
-            progress_bar.progress((i + 1) / len(markets))
-            
-            if m['market'] == local_market['market']: 
-                continue
-            
-            target_coords = agro_core.get_coordinates(m['market'])
-            if not target_coords: 
-                continue
-            
-            # Utilizing the new caching distance function
-            distance = agro_core.get_driving_distance(base_coords, target_coords, my_location, m['market'])
-            if not distance or distance > 400: 
-                continue
-            
-            financials = agro_core.calculate_real_profit(
-                commodity=commodity, 
-                distance_km=distance, 
-                buy_price_qtl=local_price, 
-                sell_price_qtl=m['modal_price'],
-                custom_freight=freight_val,
-                custom_tax=tax_val,
-                custom_labor=labor_val
-            )
-            
-            if financials['net_profit'] >= min_profit:
-                opportunities.append({
-                    "Action": "SELL TO", 
-                    "Market": m['market'], 
-                    "Distance (km)": round(distance, 1),
-                    "Buy Price": local_price, 
-                    "Sell Price": m['modal_price'], 
-                    "Gross Margin": financials['gross_profit'],
-                    "Freight": financials['freight'],
-                    "Spoilage Loss": financials['wastage_loss'],
-                    "Fees & Labor": financials['fees_and_labor'],
-                    "True Net Profit (₹)": financials['net_profit']
-                })
+        financials = agro_core.compute_profit_matrix(
+            commodity, [local_price], sell_prices, distances[None, :],
+            max_distance=MAX_ROUTE_KM, min_profit=min_profit,
+            custom_freight=freight_val, custom_tax=tax_val, custom_labor=labor_val, model=model
+        )
+        
+        opportunities = []
+        for j in np.nonzero(financials['viable'][0])[0]:
+            opportunities.append({
+                "Action": "SELL TO", 
+                "Market": routes[j]['to'], 
+                "Distance (km)": round(float(distances[j]), 1),
+                "Buy Price": local_price, 
+                "Sell Price": routes[j]['sell_price'], 
+                "Gross Margin": financials['gross_profit'][0, j],
+                "Freight": financials['freight'][0, j],
+                "Spoilage Loss": financials['wastage_loss'][0, j],
+                "Fees & Labor": financials['fees_and_labor'][0, j],
+                "True Net Profit (₹)": financials['net_profit'][0, j]
+            })
                 
         if opportunities:
             df_results = pd.DataFrame(opportunities).sort_values(by="True Net Profit (₹)", ascending=False)
@@ -99,6 +128,20 @@ if st.sidebar.button("Analyze Routes 🚀"):
                 df_results[col] = df_results[col].apply(lambda x: f"₹{x:,.0f}")
             
             st.dataframe(df_results, use_container_width=True)
-            st.balloons()
+            if clicked:
+                st.balloons()
         else:
             st.info("📉 No profitable routes found matching your criteria after deducting all taxes, fees, and spoilage.")
+
+        # Best route's profit across a freight x tax grid around the current settings, in one vectorized sweep
+        if routes:
+            base_rate = freight_val if freight_val is not None else model.freight_rate
+            base_tax = tax_val if tax_val is not None else model.tax
+            rates = base_rate * np.array([0.8, 0.9, 1.0, 1.1, 1.2])
+            taxes = np.clip(base_tax + np.array([-0.01, -0.005, 0.0, 0.005, 0.01]), 0, None)
+            sweep = model.sweep(commodity, distances, local_price, sell_prices, rates, taxes, custom_labor=labor_val)
+            best = sweep['net_profit'].max(axis=-1)
+            with st.expander("📊 Profit Sensitivity (best route)", expanded=False):
+                st.caption("Best True Net Profit across every route within range, for nearby freight and mandi tax settings.")
+                grid = pd.DataFrame(best, index=[f"₹{r:g}/km" for r in rates], columns=[f"{t * 100:.1f}% tax" for t in taxes])
+                st.dataframe(grid.style.format("₹{:,.0f}"), use_container_width=True)
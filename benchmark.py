@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import agro_core
+import agro_metrics
+import db_updater
+import telegram_alert
+
+# ==========================================
+# ⏱️ BENCHMARK CONFIGURATION
+# ==========================================
+# Fully offline: every market location and every route the scans can ask for is pre-seeded,
+# and the network hooks are pointed at dead ends so a cache miss fails fast instead of calling out.
+SCALES = {
+    "small": {"markets": 100, "states": 4, "commodities": 4, "days": 7},
+    "medium": {"markets": 500, "states": 8, "commodities": 6, "days": 7},
+    "large": {"markets": 2000, "states": 16, "commodities": 8, "days": 7},
+}
+COMMODITIES = ["Tomato", "Onion", "Wheat", "Paddy", "Soybean", "Mustard", "Maize", "Potato"]
+ROUTE_SEED_KM = 500      # seed route_cache for every pair this close (covers the 400/450 km caps)
+ROAD_FACTOR = 1.3        # synthetic road km per great-circle km
+
+def _offline_geocode(query):
+    raise RuntimeError(f"network disabled in benchmarks (geocode {query!r})")
+
+def _go_offline():
+    agro_core.OSRM_URL = "http://127.0.0.1:9"
+    agro_core.OSRM_MIN_INTERVAL = 0
+    agro_core._geocode = _offline_geocode
+    telegram_alert.TELEGRAM_API = "http://127.0.0.1:9"
+
+def generate_dataset(db_path, markets, states, commodities, days, seed=7):
+    """Writes a synthetic mandi_prices feed and fully seeded location/route caches to db_path.
+
+    Markets are clustered around one centre per state inside India's bounding box. Returns the
+    price rows (for the ingest benchmark), the state names and the number of seeded routes.
+    """
+    rng = np.random.default_rng(seed)
+    state_names = [f"State {i:02d}" for i in range(states)]
+    centres = np.column_stack([rng.uniform(10, 30, states), rng.uniform(70, 88, states)])
+    market_state = rng.integers(0, states, markets)
+    lat = centres[market_state, 0] + rng.normal(0, 1.2, markets)
+    lon = centres[market_state, 1] + rng.normal(0, 1.2, markets)
+    names = [f"Market {i:04d}" for i in range(markets)]
+
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE location_cache (city_name TEXT PRIMARY KEY, lat REAL, lon REAL)")
+    conn.execute("CREATE TABLE route_cache (origin TEXT, destination TEXT, distance_km REAL, UNIQUE(origin, destination))")
+    conn.executemany("INSERT INTO location_cache VALUES (?, ?, ?)", zip(names, lat.tolist(), lon.tolist()))
+
+    routes = []
+    for i in range(markets):
+        gc = agro_core.haversine_km(lat[i], lon[i], lat, lon)
+        for j in np.nonzero((gc <= ROUTE_SEED_KM) & (np.arange(markets) != i))[0]:
+            routes.append((names[i], names[j], float(gc[j] * ROAD_FACTOR)))
+    conn.executemany("INSERT INTO route_cache VALUES (?, ?, ?)", routes)
+    conn.commit()
+    conn.close()
+
+    crops = COMMODITIES[:commodities]
+    base = {c: rng.uniform(800, 3000) for c in crops}
+    today = datetime.now().date()
+    rows = []
+    for d in range(days):
+        day = (today - timedelta(days=d)).isoformat()
+        for i, name in enumerate(names):
+            for crop in crops:
+                if rng.random() < 0.7:
+                    price = round(base[crop] * rng.uniform(0.6, 1.4), 0)
+                    rows.append((state_names[market_state[i]], name, crop, price, day))
+    df = pd.DataFrame(rows, columns=["state", "market", "commodity", "modal_price", "arrival_date"])
+    return df, state_names, len(routes)
+
+def _feed_records(df):
+    """Price rows in the data.gov.in record shape (dd/mm/yyyy dates, prices as strings)."""
+    days = pd.to_datetime(df["arrival_date"]).dt.strftime("%d/%m/%Y")
+    return [{"state": s, "market": m, "commodity": c, "modal_price": str(p), "arrival_date": d}
+            for s, m, c, p, d in zip(df["state"], df["market"], df["commodity"], df["modal_price"], days)]
+
+def _replay_feed(records):
+    """Serves `records` to db_updater's page fetcher, so ingest_national_feed runs its real pipeline offline."""
+    def fetch_page(session, offset):
+        return {"total": len(records), "records": records[offset:offset + db_updater.PAGE_SIZE]}
+    db_updater._fetch_page = fetch_page
+
+def _ingest(records):
+    _replay_feed(records)
+    return db_updater.ingest_national_feed()
+
+def _time(fn, repeat):
+    """Runs fn `repeat` times; returns timing stats in seconds and the last result."""
+    samples, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return {"min_s": min(samples), "median_s": statistics.median(samples), "runs": repeat}, result
+
+def run_scale(name, params, repeat, workdir, seed):
+    print(f"⏱️ Scale '{name}': {params}")
+    db_path = os.path.join(workdir, f"bench_{name}.db")
+    prices, states, route_rows = generate_dataset(db_path, seed=seed, **params)
+
+    agro_core.DB_NAME = db_path
+    agro_core.SNAPSHOT_DIR = os.path.join(workdir, f"snapshot_{name}")
+    agro_core.TRUSTED_STATES = states
+    crops = COMMODITIES[:params["commodities"]]
+    half = len(states) // 2 or 1
+    regions = {"region_a": states[:half], "region_b": states[half - 1:]}   # overlapping on purpose
+    timings = {}
+    agro_metrics.reset()
+
+    # --- INGEST ---
+    # The daily workflow's path: paged feed walk -> parse_records -> batched upserts with checkpoints
+    full = _feed_records(prices)
+    shifted = _feed_records(prices.sample(frac=0.1, random_state=seed).assign(modal_price=lambda d: d["modal_price"] + 10))
+    timings["ingest_full"], _ = _time(lambda: _ingest(full), 1)
+    timings["ingest_delta_10pct"], _ = _time(lambda: _ingest(shifted), 1)
+    timings["ingest_unchanged"], _ = _time(lambda: _ingest(shifted), 1)
+    timings["export_snapshot"], _ = _time(agro_core.export_snapshot, 1)
+
+    # --- UI QUERY PATH ---
+    origin = prices["market"].iloc[0]
+    timings["fetch_trusted_data_snapshot"], _ = _time(lambda: agro_core.fetch_trusted_data(crops[0]), repeat)
+    timings["load_market_prices_snapshot"], _ = _time(lambda: agro_core.load_market_prices(crops, states), repeat)
+    snapshot_dir, agro_core.SNAPSHOT_DIR = agro_core.SNAPSHOT_DIR, os.path.join(workdir, "no_snapshot")
+    agro_core.SNAPSHOT_AUTO_BUILD = False
+    timings["fetch_trusted_data_sql"], _ = _time(lambda: agro_core.fetch_trusted_data(crops[0]), repeat)
+    timings["load_market_prices_sql"], _ = _time(lambda: agro_core.load_market_prices(crops, states), repeat)
+    agro_core.SNAPSHOT_DIR, agro_core.SNAPSHOT_AUTO_BUILD = snapshot_dir, True
+    timings["find_routes_single_origin"], routes = _time(
+        lambda: agro_core.find_routes([crops[0]], origins=[origin], states=states, top_k=None, max_distance=400, min_profit=None), repeat)
+
+    # --- COST MODEL ---
+    n = max(len(routes), 1)
+    dist = np.full(n, 250.0)
+    buy = np.full(n, 1500.0)
+    sell = np.full(n, 2200.0)
+    timings["calculate_real_profit_scalar_loop"], _ = _time(
+        lambda: [agro_core.calculate_real_profit(crops[0], dist[k], buy[k], sell[k]) for k in range(n)], repeat)
+    timings["compute_profit_matrix_vector"], _ = _time(
+        lambda: agro_core.compute_profit_matrix(crops[0], buy[:1], sell, dist[None, :]), repeat)
+    timings["cost_model_sweep_5x5"], _ = _time(
+        lambda: agro_core.cost_model().sweep(crops[0], dist, buy, sell, np.linspace(25, 45, 5), np.linspace(0.01, 0.05, 5)), repeat)
+
+    # --- SCAN PATH ---
+    timings["scan_for_deals_one_region"], deals = _time(
+        lambda: telegram_alert.scan_for_deals(regions["region_a"], min_profit=1000, crops=crops), repeat)
+    timings["schedule_region_scans"], region_deals = _time(
+        lambda: telegram_alert.schedule_region_scans(regions, min_profit=1000, crops=crops), repeat)
+
+    # --- PRECOMPUTED DEALS (after the live scans, which would otherwise be served from the table) ---
+    timings["build_daily_deals"], deal_rows = _time(lambda: agro_core.build_daily_deals(crops, states), 1)
+    timings["find_routes_single_origin_daily_deals"], _ = _time(
+        lambda: agro_core.find_routes([crops[0]], origins=[origin], states=states, top_k=None, max_distance=400, min_profit=0), repeat)
+    timings["schedule_region_scans_daily_deals"], _ = _time(
+        lambda: telegram_alert.schedule_region_scans(regions, min_profit=1000, crops=crops), repeat)
+
+    agro_core.close_connections()
+    return {
+        "scale": name, "params": params,
+        "dataset": {"price_rows": len(prices), "route_cache_rows": route_rows, "daily_deals_rows": deal_rows},
+        "outputs": {"ui_routes": len(routes), "region_a_deals": len(deals),
+                    "scheduled_deals": {k: len(v) for k, v in region_deals.items()}},
+        "timings": timings,
+        **({"metrics": agro_metrics.report()} if agro_metrics.ENABLED else {}),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the ingest, scan and UI query paths.")
+    parser.add_argument("--scales", default="small,medium", help=f"comma-separated subset of {', '.join(SCALES)}")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per timed query (min and median are reported)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--metrics", action="store_true", help="also record per-stage metrics (adds a little overhead to every timing)")
+    args = parser.parse_args()
+
+    _go_offline()
+    agro_metrics.enable(args.metrics or agro_metrics.ENABLED)
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+                        "sqlite": sqlite3.sqlite_version, "machine": platform.machine(), "cpus": os.cpu_count()},
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.scales.split(","):
+            report["results"].append(run_scale(name.strip(), SCALES[name.strip()], args.repeat, workdir, args.seed))
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"📊 Benchmark results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
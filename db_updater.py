@@ -1,104 +1,242 @@
-import sqlite3
-import pandas as pd
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
+import agro_core
+import agro_metrics
 
 # ==========================================
 # 🔄 DATABASE UPDATER CONFIGURATION
 # ==========================================
-DB_NAME = "agro_data.db"
+# The database file and its schema/migrations live in agro_core (agro_core.DB_NAME)
 # You will get this free key from data.gov.in
 API_KEY = "579b464db66ec23bdd0000017c689950564f49c55cd9635e63c4ae8e" 
-# The official endpoint for real-time Mandi prices
-API_URL = f"https://api.data.gov.in/resource/9ef84268-d588-465a-a308-a864a43d0070?api-key={API_KEY}&format=json&limit=2000"
+# The official endpoint for real-time Mandi prices (tests point API_BASE at tests/replay_server.py)
+API_BASE = "https://api.data.gov.in/resource/9ef84268-d588-465a-a308-a864a43d0070"
 
-def fetch_fresh_mandi_data():
-    """Pulls the latest agricultural prices directly from the Government of India API."""
-    print("📡 Contacting Govt. of India API for fresh Mandi prices...")
-    
-    try:
-        response = requests.get(API_URL)
-        if response.status_code == 200:
-            data = response.json()
-            records = data.get('records', [])
-            
-            if not records:
-                print("⚠️ API returned empty records today.")
-                return pd.DataFrame()
-                
-            # Convert the raw JSON into a clean Pandas DataFrame
-            df = pd.DataFrame(records)
-            
-            # Rename government columns to match our database structure
-            df.rename(columns={
-                'state': 'state',
-                'market': 'market',
-                'commodity': 'commodity',
-                'modal_price': 'modal_price',
-                'arrival_date': 'arrival_date'
-            }, inplace=True)
-            
-            # Ensure price is a number
-            df['modal_price'] = pd.to_numeric(df['modal_price'], errors='coerce')
-            # Drop any rows where price data is missing
-            df.dropna(subset=['modal_price'], inplace=True)
-            
-            print(f"✅ Successfully downloaded {len(df)} fresh records.")
-            return df
-        else:
-            print(f"❌ API Connection Failed: Status Code {response.status_code}")
-            return pd.DataFrame()
-            
-    except Exception as e:
-        print(f"❌ Network Error: {e}")
-        return pd.DataFrame()
-
-def update_database(fresh_df):
-    """Saves the new prices and deletes old data to keep the database fast."""
-    if fresh_df.empty:
-        print("⏭️ No new data to update.")
-        return
-
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    # 1. Ensure our table exists
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS mandi_prices (
-            state TEXT, market TEXT, commodity TEXT, 
-            modal_price REAL, arrival_date TEXT
+# Streaming ingestion of the full national feed
+FEED_NAME = "mandi_prices"
+PAGE_SIZE = 1000          # records per API page
+PAGES_IN_FLIGHT = 4       # concurrent page requests
+UPSERT_BATCH = 5000       # rows per write transaction (and checkpoint)
+API_TIMEOUT = 30          # seconds per page request
+KEEP_DAYS = 7             # hot mandi_prices window
+# Size budget: the workflow commits agro_data.db and GitHub rejects files over 100 MB, so the database
+# is kept under DB_SIZE_BUDGET_MB. At ~10k feed rows a day the 7-day hot table is ~15 MB, the daily
+# history ~20 MB and the weekly rollups ~20 MB; longer windows need a store outside the repository.
+# The history windows are agro_core.HISTORY_DAILY_DAYS / HISTORY_WEEKLY_WEEKS, which readers also use.
+DB_SIZE_BUDGET_MB = 80
+
+def _start_run(conn):
+    with conn:
+        cur = conn.execute("INSERT INTO update_runs (started_at) VALUES (?)", (datetime.now().isoformat(timespec='seconds'),))
+    return cur.lastrowid
+
+def _finish_run(conn, run_id):
+    with conn:
+        conn.execute("UPDATE update_runs SET finished_at = ? WHERE run_id = ?", (datetime.now().isoformat(timespec='seconds'), run_id))
+    seen, new, changed = conn.execute("SELECT rows_seen, rows_new, rows_changed FROM update_runs WHERE run_id = ?", (run_id,)).fetchone()
+    print(f"🧮 Run {run_id}: {seen} rows seen, {new} new, {changed} changed, {seen - new - changed} unchanged (skipped).")
+
+@agro_metrics.timed("sqlite.upsert")
+def _upsert_rows(conn, rows, run_id):
+    """Diffs (state, market, commodity, modal_price, arrival_date) rows against mandi_prices and writes only new or changed ones.
+
+    Must run inside a transaction. Every write is also recorded in price_changes under `run_id`.
+    """
+    conn.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS incoming (
+            state TEXT, market TEXT, commodity TEXT, modal_price REAL, arrival_date TEXT, commodity_id INTEGER, market_id INTEGER,
+            PRIMARY KEY (state, market, commodity, arrival_date)
         )
     ''')
-    
-   # 2. Add the fresh data safely (Update if exists, Insert if new)
-    data_to_insert = fresh_df[['state', 'market', 'commodity', 'modal_price', 'arrival_date']].values.tolist()
-
-    cursor.executemany('''
-        INSERT OR REPLACE INTO mandi_prices (state, market, commodity, modal_price, arrival_date)
-        VALUES (?, ?, ?, ?, ?)
-    ''', data_to_insert)
-    
-    # 3. Clean up the database (Delete data older than 7 days)
+    conn.execute("DELETE FROM incoming")
+    # New commodity and market spellings get their ids and aliases here, so readers only ever filter on ids
+    commodity_ids = agro_core.register_names(conn, "commodity", {r[2] for r in rows})
+    market_ids = agro_core.register_names(conn, "market", {r[1] for r in rows})
+    # Later duplicates inside the batch win, same as the old dedupe
+    conn.executemany("INSERT OR REPLACE INTO incoming (state, market, commodity, modal_price, arrival_date, commodity_id, market_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     [(*r, commodity_ids[r[2]], market_ids[r[1]]) for r in rows])
+
+    # 1. Log what is about to move
+    cur = conn.execute('''
+        INSERT INTO price_changes (run_id, state, market, commodity, arrival_date, old_price, new_price)
+        SELECT ?, i.state, i.market, i.commodity, i.arrival_date, p.modal_price, i.modal_price
+        FROM incoming i
+        LEFT JOIN mandi_prices p
+          ON p.state = i.state AND p.market = i.market AND p.commodity = i.commodity AND p.arrival_date = i.arrival_date
+        WHERE p.modal_price IS NOT i.modal_price
+    ''', (run_id,))
+    written = cur.rowcount
+
+    # 2. Apply it; identical prices are skipped so untouched pages stay untouched on disk
+    conn.execute('''
+        INSERT INTO mandi_prices (state, market, commodity, modal_price, arrival_date, commodity_id, market_id)
+        SELECT state, market, commodity, modal_price, arrival_date, commodity_id, market_id FROM incoming WHERE true
+        ON CONFLICT(state, market, commodity, arrival_date) DO UPDATE SET modal_price = excluded.modal_price
+        WHERE mandi_prices.modal_price IS NOT excluded.modal_price
+    ''')
+
+    # 3. Keep the long-term analytics history in step (it outlives the 7-day hot table)
+    conn.execute(f'''
+        INSERT INTO price_history (commodity_id, market, state, day, price)
+        SELECT commodity_id, market, state, {agro_core.DAY_NUMBER_SQL.format(col='arrival_date')}, modal_price FROM incoming WHERE true
+        ON CONFLICT(commodity_id, market, state, day) DO UPDATE SET price = excluded.price
+        WHERE price_history.price IS NOT excluded.price
+    ''')
+
+    new = conn.execute("SELECT COUNT(*) FROM price_changes WHERE run_id = ? AND old_price IS NULL", (run_id,)).fetchone()[0]
+    conn.execute('''
+        UPDATE update_runs SET rows_seen = rows_seen + ?, rows_new = ?,
+               rows_changed = (SELECT COUNT(*) FROM price_changes WHERE run_id = ? AND old_price IS NOT NULL)
+        WHERE run_id = ?
+    ''', (len(rows), new, run_id, run_id))
+    agro_metrics.count("ingest.rows_seen", len(rows))
+    agro_metrics.count("ingest.rows_written", written)
+    return written
+
+@agro_metrics.timed("sqlite.prune")
+def _prune_old_rows(conn):
+    """Deletes hot data older than KEEP_DAYS, rolls up old history and hands the freed pages back to the filesystem."""
     # This is crucial so your GitHub repository doesn't run out of storage space
-    seven_days_ago = (datetime.now() - timedelta(days=7)).strftime('%d/%m/%Y')
-    cursor.execute("DELETE FROM mandi_prices WHERE arrival_date < ?", (seven_days_ago,))
-    
-    # 4. Remove duplicate entries (same market, same crop, same day)
-    cursor.execute("""
-        DELETE FROM mandi_prices 
-        WHERE rowid NOT IN (
-            SELECT MAX(rowid) 
-            FROM mandi_prices 
-            GROUP BY state, market, commodity, arrival_date
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
-    print("💾 Database updated and optimized successfully!")
+    cutoff = (datetime.now() - timedelta(days=KEEP_DAYS)).strftime('%Y-%m-%d')
+    # Daily history older than agro_core.HISTORY_DAILY_DAYS is folded into whole weeks
+    history_cutoff = (datetime.now() - datetime(1970, 1, 1)).days - agro_core.HISTORY_DAILY_DAYS
+    history_cutoff -= history_cutoff % 7
+    with conn:
+        conn.execute("DELETE FROM mandi_prices WHERE arrival_date < ?", (cutoff,))
+        conn.execute("DELETE FROM price_changes WHERE arrival_date < ?", (cutoff,))
+        conn.execute('''
+            INSERT INTO price_history_weekly (commodity_id, market, state, week, mean_price, min_price, max_price, samples)
+            SELECT commodity_id, market, state, day / 7, AVG(price), MIN(price), MAX(price), COUNT(*)
+            FROM price_history WHERE day < ? GROUP BY commodity_id, market, state, day / 7
+            ON CONFLICT(commodity_id, market, state, week) DO UPDATE SET
+                mean_price = (mean_price * samples + excluded.mean_price * excluded.samples) / (samples + excluded.samples),
+                min_price = MIN(min_price, excluded.min_price), max_price = MAX(max_price, excluded.max_price),
+                samples = samples + excluded.samples
+        ''', (history_cutoff,))
+        conn.execute("DELETE FROM price_history WHERE day < ?", (history_cutoff,))
+        conn.execute("DELETE FROM price_history_weekly WHERE week < ?", (history_cutoff // 7 - agro_core.HISTORY_WEEKLY_WEEKS,))
+    conn.execute("PRAGMA incremental_vacuum").fetchall()
+
+    pages, page_size = conn.execute("PRAGMA page_count").fetchone()[0], conn.execute("PRAGMA page_size").fetchone()[0]
+    size_mb = pages * page_size / 2**20
+    if size_mb > DB_SIZE_BUDGET_MB:
+        print(f"⚠️ {agro_core.DB_NAME} is {size_mb:.0f} MB, over the {DB_SIZE_BUDGET_MB} MB budget; shorten KEEP_DAYS or the history windows.")
+
+# --- STREAMING INGESTION (full national feed) ---
+def _api_session():
+    retry = Retry(total=4, backoff_factor=1.0, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_maxsize=PAGES_IN_FLIGHT, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def _fetch_page(session, offset):
+    params = {"api-key": API_KEY, "format": "json", "limit": PAGE_SIZE, "offset": offset}
+    with agro_metrics.external("data_gov_in"):
+        response = session.get(API_BASE, params=params, timeout=API_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+def parse_records(records):
+    """Validates raw feed records one at a time, yielding upsert-ready rows and skipping bad ones."""
+    for rec in records:
+        try:
+            state = (rec.get('state') or '').strip()
+            market = (rec.get('market') or '').strip()
+            commodity = (rec.get('commodity') or '').strip()
+            price = float(rec.get('modal_price'))
+            day = datetime.strptime(rec.get('arrival_date', ''), '%d/%m/%Y').strftime('%Y-%m-%d')
+        except (TypeError, ValueError):
+            agro_metrics.count("ingest.rows_rejected")
+            continue
+        if state and market and commodity and price > 0:
+            yield (state, market, commodity, price, day)
+
+def iter_feed_pages(start_offset=0):
+    """Walks the API with offset pagination, keeping PAGES_IN_FLIGHT requests open; yields (offset, records) in order."""
+    session = _api_session()
+    try:
+        first = _fetch_page(session, start_offset)
+        yield start_offset, first.get('records', [])
+        total = int(first.get('total') or 0)
+
+        offsets = iter(range(start_offset + PAGE_SIZE, total, PAGE_SIZE))
+        with ThreadPoolExecutor(max_workers=PAGES_IN_FLIGHT) as pool:
+            # A bounded window of futures keeps memory flat no matter how big the feed is
+            window = deque((off, pool.submit(_fetch_page, session, off)) for off in itertools.islice(offsets, PAGES_IN_FLIGHT))
+            while window:
+                off, future = window.popleft()
+                records = future.result().get('records', [])
+                for nxt in itertools.islice(offsets, 1):
+                    window.append((nxt, pool.submit(_fetch_page, session, nxt)))
+                yield off, records
+    finally:
+        session.close()
+
+def ingest_national_feed(resume=True):
+    """Streams the whole national feed into mandi_prices in batched transactions, resuming from today's checkpoint."""
+    conn = agro_core.get_connection()
+    today = datetime.now().strftime('%Y-%m-%d')
+
+    start = 0
+    if resume:
+        cp = conn.execute("SELECT run_day, next_offset, finished FROM ingest_checkpoint WHERE feed = ?", (FEED_NAME,)).fetchone()
+        if cp and cp[0] == today and not cp[2]:
+            start = cp[1]
+            print(f"↩️ Resuming today's ingest from record {start}...")
+
+    run_id = _start_run(conn)
+    print(f"📡 Streaming national Mandi feed ({PAGE_SIZE} records/page, {PAGES_IN_FLIGHT} in flight)...")
+    offset, stored, batch = start, 0, []
+
+    def flush():
+        with conn:
+            _upsert_rows(conn, batch, run_id)
+            # The checkpoint commits together with the rows it covers
+            conn.execute("INSERT OR REPLACE INTO ingest_checkpoint (feed, run_day, next_offset, total, finished) VALUES (?, ?, ?, NULL, 0)",
+                         (FEED_NAME, today, offset))
+        batch.clear()
+
+    try:
+        for page_offset, records in iter_feed_pages(start):
+            offset = page_offset + len(records)
+            for row in parse_records(records):
+                batch.append(row)
+                stored += 1
+            if len(batch) >= UPSERT_BATCH:
+                flush()
+    except Exception as e:
+        agro_metrics.error("ingest_national_feed", e)
+        if batch: flush()
+        _finish_run(conn, run_id)
+        print(f"❌ Feed interrupted at record {offset}: {e}")
+        return stored
+
+    flush()
+    with conn:
+        conn.execute("UPDATE ingest_checkpoint SET total = ?, finished = 1 WHERE feed = ?", (offset, FEED_NAME))
+    _prune_old_rows(conn)
+    _finish_run(conn, run_id)
+    print(f"✅ Stored {stored} validated records from the national feed.")
+    return stored
 
 if __name__ == "__main__":
     print("🚀 Starting Daily Database Update Sequence...")
-    fresh_data = fetch_fresh_mandi_data()
-    update_database(fresh_data)
+    with agro_metrics.stage("ingest_national_feed"):
+        ingest_national_feed()
+    # Keep the market location index complete so scans never geocode inline
+    if os.path.exists(agro_core.GAZETTEER_CSV):
+        agro_core.import_gazetteer(agro_core.GAZETTEER_CSV)
+    agro_core.resolve_new_markets()
+    agro_core.export_snapshot()
+    # Precompute every route the app and bot serve, so neither routes interactively
+    agro_core.build_daily_deals()
     print("🏁 Sequence Complete.")
+    agro_metrics.write_report("updater")
@@ -1,7 +1,11 @@
+import asyncio
+import heapq
+import os
 import requests
-import sqlite3
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import agro_core 
+import agro_metrics
 
 # ==========================================
 # 📱 CONFIGURATION
@@ -20,67 +24,200 @@ VIP_REGIONS = {
     "vip_north": ["Haryana", "Rajasthan", "Punjab"]
 }
 
+# Delivery (tests point TELEGRAM_API at the mock Bot API in tests/replay_server.py)
+TELEGRAM_API = "https://api.telegram.org"
+TELEGRAM_TIMEOUT = 15
+MAX_MESSAGE_CHARS = 4096      # Bot API hard limit per message
+GLOBAL_SEND_INTERVAL = 1 / 30 # Bot API allows ~30 messages/second overall
+CHAT_SEND_INTERVAL = 3.0      # ...and ~20 messages/minute into one channel
+MAX_SEND_ATTEMPTS = 5
+
 def get_latest_date():
-    conn = sqlite3.connect(agro_core.DB_NAME)
-    dates_df = pd.read_sql_query("SELECT DISTINCT arrival_date FROM mandi_prices", conn)
-    conn.close()
-    if dates_df.empty: return None
-    return pd.to_datetime(dates_df['arrival_date'], format='%d/%m/%Y').max().strftime('%d/%m/%Y')
+    # arrival_date is ISO, so MAX() is a single seek on the (arrival_date, ...) index
+    return agro_core.get_connection().execute("SELECT MAX(arrival_date) FROM mandi_prices").fetchone()[0]
+
+def split_message(text, limit=MAX_MESSAGE_CHARS):
+    """Splits text into Telegram-sized parts, preferring paragraph, then line, boundaries."""
+    parts, current = [], ""
+    for block in text.split("\n\n"):
+        candidate = f"{current}\n\n{block}" if current else block
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current:
+            parts.append(current)
+        current = ""
+        for line in block.split("\n"):
+            candidate = f"{current}\n{line}" if current else line
+            if len(candidate) <= limit:
+                current = candidate
+                continue
+            if current:
+                parts.append(current)
+            # A single line longer than the limit gets a hard cut
+            while len(line) > limit:
+                parts.append(line[:limit])
+                line = line[limit:]
+            current = line
+    if current:
+        parts.append(current)
+    return parts
+
+def _spacer(interval):
+    """Async gate that lets callers through at most once per `interval` seconds."""
+    lock = asyncio.Lock()
+    next_slot = 0.0
+
+    async def wait():
+        nonlocal next_slot
+        async with lock:
+            loop = asyncio.get_running_loop()
+            delay = next_slot - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_slot = max(loop.time(), next_slot) + interval
+    return wait
+
+async def _deliver_part(session, chat_id, text, global_gate, chat_gate):
+    """Sends one message part, retrying on 429 (honouring retry_after), 5xx and network errors.
+
+    No backoff is slept after the last attempt, so an undeliverable part does not delay the rest.
+    """
+    url = f"{TELEGRAM_API}/bot{TELEGRAM_TOKEN}/sendMessage"
+    payload = {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
+    error = None
+    for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+        await chat_gate()
+        await global_gate()
+        try:
+            with agro_metrics.external("telegram"):
+                res = await asyncio.to_thread(session.post, url, json=payload, timeout=TELEGRAM_TIMEOUT)
+                body = res.json()
+        except (requests.RequestException, ValueError) as e:
+            error = str(e)
+            if attempt < MAX_SEND_ATTEMPTS:
+                await asyncio.sleep(2 ** attempt)
+            continue
+
+        if body.get("ok"):
+            return {"chat_id": chat_id, "ok": True, "attempts": attempt, "error": None}
+        error = body.get("description", f"HTTP {res.status_code}")
+        last = attempt == MAX_SEND_ATTEMPTS
+        if res.status_code == 429:
+            agro_metrics.count("telegram.rate_limited")
+            if not last:
+                await asyncio.sleep(body.get("parameters", {}).get("retry_after", 2 ** attempt))
+        elif res.status_code >= 500:
+            if not last:
+                await asyncio.sleep(2 ** attempt)
+        elif "parse entities" in error and "parse_mode" in payload:
+            # Market names with stray * or _ break Markdown; send the same text unformatted instead
+            payload.pop("parse_mode")
+        else:
+            break
+    agro_metrics.count("telegram.undelivered")
+    return {"chat_id": chat_id, "ok": False, "attempts": attempt, "error": error}
+
+async def _deliver_all(messages):
+    chats = {}
+    for chat_id, text in messages:
+        chats.setdefault(chat_id, []).extend(split_message(text))
+
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_maxsize=max(len(chats), 1)))
+    session.mount("http://", HTTPAdapter(pool_maxsize=max(len(chats), 1)))
+    global_gate = _spacer(GLOBAL_SEND_INTERVAL)
+
+    async def deliver_chat(chat_id, parts):
+        # Parts of one chat go out in order; different chats run concurrently
+        chat_gate = _spacer(CHAT_SEND_INTERVAL)
+        return [await _deliver_part(session, chat_id, part, global_gate, chat_gate) for part in parts]
+
+    try:
+        per_chat = await asyncio.gather(*(deliver_chat(c, parts) for c, parts in chats.items()))
+    finally:
+        session.close()
+    return [result for results in per_chat for result in results]
+
+@agro_metrics.timed("telegram.delivery")
+def send_messages(messages):
+    """Delivers [(chat_id, text), ...] to all chats concurrently and returns one result dict per message part."""
+    return asyncio.run(_deliver_all(messages))
 
 def send_telegram(chat_id, text):
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-    requests.post(url, json={"chat_id": chat_id, "text": text, "parse_mode": "Markdown"})
+    return send_messages([(chat_id, text)])
+
+SCAN_WORKERS = os.cpu_count() or 4
+SCAN_CROPS = ['Tomato', 'Soybean', 'Paddy', 'Wheat', 'Mustard', 'Onion', 'Potato', 'Maize']
 
-def scan_for_deals(target_states, min_profit=1000):
+def scan_for_deals(target_states, min_profit=1000, crops=None):
     """Scans for deals ONLY within the specified regional states to prevent infinite loops."""
-    all_deals = []
     latest_date = get_latest_date()
     if not latest_date: return []
 
-    conn = sqlite3.connect(agro_core.DB_NAME)
-    crops = ['Tomato', 'Soybean', 'Paddy', 'Wheat', 'Mustard', 'Onion', 'Potato', 'Maize']
-    
-    for crop in crops:
-        query = "SELECT state, market, modal_price FROM mandi_prices WHERE commodity LIKE ? AND arrival_date = ?"
-        df = pd.read_sql_query(query, conn, params=[f'%{crop}%', latest_date]).drop_duplicates(subset=['market'])
-        markets = df.to_dict('records')
-        
-        # Limit both origin and destination to the region to cut math calculations by 90%
-        regional_markets = [m for m in markets if m['state'] in target_states]
-        
-        for origin in regional_markets:
-            base_coords = agro_core.get_coordinates(origin['market'])
-            if not base_coords: continue
-            
-            for target in regional_markets:
-                if origin['market'] == target['market']: continue
-                target_coords = agro_core.get_coordinates(target['market'])
-                if not target_coords: continue
-                
-                dist = agro_core.get_driving_distance(base_coords, target_coords, origin['market'], target['market'])
-                if dist and dist <= 450: 
-                    fin = agro_core.calculate_real_profit(crop, dist, origin['modal_price'], target['modal_price'])
-                    if fin["net_profit"] >= min_profit:
-                        all_deals.append({
-                            "crop": crop, "from": origin['market'], "to": target['market'],
-                            "profit": fin["net_profit"], "dist": dist, "details": fin
-                        })
-    conn.close()
-    return sorted(all_deals, key=lambda x: x['profit'], reverse=True)
+    # Every crop in one batched query; origin and destination both stay inside the region
+    return agro_core.find_routes(SCAN_CROPS if crops is None else crops, states=target_states, top_k=None,
+                                 max_distance=450, min_profit=min_profit, arrival_date=latest_date)
+
+@agro_metrics.timed("schedule_region_scans")
+def schedule_region_scans(regions, min_profit=1000, crops=None, workers=SCAN_WORKERS):
+    """Scans every (region, crop) task on a thread pool and returns {channel_key: deals}, best first.
+
+    Prices are read once for all regions, every market is geocoded once, straight-line candidates
+    are computed once per crop and sliced per region, and the routes all tasks need are fetched in
+    one deduplicated prefetch, so overlapping regions share the work.
+    """
+    latest_date = get_latest_date()
+    if not latest_date: return {key: [] for key in regions}
+
+    crops = SCAN_CROPS if crops is None else crops
+    all_states = sorted({state for states in regions.values() for state in states})
+    # The updater materializes these routes after ingest; serve every region from that table when it is current
+    if agro_core.daily_deals_ready(crops, all_states):
+        return {key: agro_core.query_daily_deals(crops, states=states, top_k=None, max_distance=450,
+                                                 min_profit=min_profit, arrival_date=latest_date)
+                for key, states in regions.items()}
+
+    prices = agro_core.load_market_prices(crops, states=all_states, arrival_date=latest_date)
+    for name in prices['market'].unique():
+        agro_core.get_coordinates(name)
+
+    tasks = [(key, crop) for key in regions for crop in crops]
+
+    def plan(task):
+        key, crop = task
+        part = prices[(prices['crop'] == crop) & prices['state'].isin(regions[key])]
+        return agro_core.plan_routes(part, max_distance=450, min_profit=min_profit, candidates=candidates[crop])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # The spatial search is the Python-heavy part, so it runs once per crop rather than once per region
+        candidates = dict(zip(crops, pool.map(
+            lambda crop: agro_core.great_circle_index(prices.loc[prices['crop'] == crop, 'market'], 450), crops)))
+        planned = list(pool.map(plan, tasks))
+        pairs = {pair for _, task_pairs in planned for pair in task_pairs}
+        routes = agro_core.prefetch_routes(None, pairs=pairs) if pairs else {}
+        ranked = list(pool.map(lambda p: agro_core.rank_routes(p[0], routes, top_k=None, max_distance=450, min_profit=min_profit), planned))
+
+    results = {key: [] for key in regions}
+    for (key, _), deals in zip(tasks, ranked):
+        results[key].extend(deals)
+    return {key: sorted(deals, key=lambda x: x['profit'], reverse=True) for key, deals in results.items()}
 
 def run_daily_broadcast():
-    all_national_deals = []
+    all_national_deals = {}
+    outbox = []
 
-    # 1. Process VIP Channels First
-    for channel_key, states in VIP_REGIONS.items():
-        print(f"🔍 Scanning VIP Region: {channel_key}...")
-        deals = scan_for_deals(target_states=states, min_profit=1000)
-        
+    # 1. Process VIP Channels First (every region is scanned in parallel)
+    print(f"🔍 Scanning VIP Regions: {', '.join(VIP_REGIONS)}...")
+    region_deals = schedule_region_scans(VIP_REGIONS, min_profit=1000)
+
+    for channel_key, deals in region_deals.items():
         if not deals:
             continue
 
-        # Save these deals to a master list so we can recycle them for the Free channel
-        all_national_deals.extend(deals) 
+        # Save these deals to a master list so we can recycle them for the Free channel (overlapping regions count once)
+        for d in deals:
+            all_national_deals[(d['commodity_id'], d['from'], d['to'])] = d
 
         msg = f"🚜 **{channel_key.replace('_', ' ').upper()} - DAILY TRADE REPORT**\n"
         msg += f"Found {len(deals)} profitable routes today.\n\n"
@@ -88,26 +225,36 @@ def run_daily_broadcast():
         for d in deals[:8]: 
             f = d['details']
             msg += (
-                f"📍 **{d['crop']}**: {d['from']} ➡️ {d['to']}\n"
+                f"📍 **{d['variety']}**: {d['from']} ➡️ {d['to']}\n"
                 f"💰 Profit: *₹{d['profit']:,.0f}* | Dist: {d['dist']:.0f}km\n"
                 f"   (Freight: -₹{f['freight']:.0f} | Fees: -₹{f['fees_and_labor']:.0f})\n\n"
             )
-        send_telegram(CHANNELS[channel_key], msg)
-        print(f"✅ VIP Alert sent to {channel_key}!")
+        outbox.append((CHANNELS[channel_key], msg))
+        print(f"✅ VIP Alert queued for {channel_key}!")
 
     # 2. Recycle the best data for the Free Channel
     if all_national_deals:
         print("📢 Broadcasting Free Top 3...")
         # Sort all the collected regional deals by highest profit
-        top_3 = sorted(all_national_deals, key=lambda x: x['profit'], reverse=True)[:3]
+        top_3 = heapq.nlargest(3, all_national_deals.values(), key=lambda x: x['profit'])
         
         msg = "🏆 **TOP 3 REGIONAL ARBITRAGE OPPORTUNITIES** 🏆\n\n"
         for i, d in enumerate(top_3, 1):
-            msg += f"{i}. **{d['crop']}**: {d['from']} ➡️ {d['to']}\n   🔥 Net Profit: *₹{d['profit']:,.0f}*\n\n"
+            msg += f"{i}. **{d['variety']}**: {d['from']} ➡️ {d['to']}\n   🔥 Net Profit: *₹{d['profit']:,.0f}*\n\n"
         
         msg += f"📈 *Get full cost breakdowns and local routes for your state in VIP:*\n{COSMOFEED_LINK}"
-        send_telegram(CHANNELS["free"], msg)
-        print("✅ Free Top 3 Alert sent!")
+        outbox.append((CHANNELS["free"], msg))
+        print("✅ Free Top 3 Alert queued!")
+
+    # 3. Deliver everything concurrently and report what actually arrived
+    if outbox:
+        results = send_messages(outbox)
+        delivered = sum(r["ok"] for r in results)
+        print(f"📬 Delivered {delivered}/{len(results)} messages.")
+        for r in results:
+            if not r["ok"]:
+                print(f"❌ Delivery to {r['chat_id']} failed after {r['attempts']} attempts: {r['error']}")
 
 if __name__ == "__main__":
     run_daily_broadcast()
+    agro_metrics.write_report("broadcast")
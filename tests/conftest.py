@@ -0,0 +1,33 @@
+import os
+import sys
+import pytest
+
+# Tests import the flat root modules (agro_core, db_updater, telegram_alert); run with `python -m pytest tests`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import agro_core
+import db_updater
+import telegram_alert
+from replay_server import ReplayServer
+
+@pytest.fixture
+def tmp_db(tmp_path, monkeypatch):
+    """A fresh database (and snapshot directory) per test; the committed agro_data.db is never touched."""
+    monkeypatch.setattr(agro_core, "DB_NAME", str(tmp_path / "agro_test.db"))
+    monkeypatch.setattr(agro_core, "SNAPSHOT_DIR", str(tmp_path / "market_snapshot"))
+    yield agro_core.get_connection()
+    agro_core.close_connections()
+
+@pytest.fixture
+def replay(monkeypatch):
+    """The replay server, with the feed, OSRM and Telegram endpoints of every module pointed at it."""
+    with ReplayServer() as server:
+        monkeypatch.setattr(db_updater, "API_BASE", f"{server.url}/resource/9ef84268-d588-465a-a308-a864a43d0070")
+        monkeypatch.setattr(db_updater, "PAGE_SIZE", 4)
+        monkeypatch.setattr(db_updater, "PAGES_IN_FLIGHT", 2)
+        monkeypatch.setattr(agro_core, "OSRM_URL", server.url)
+        monkeypatch.setattr(agro_core, "OSRM_MIN_INTERVAL", 0)
+        monkeypatch.setattr(telegram_alert, "TELEGRAM_API", server.url)
+        monkeypatch.setattr(telegram_alert, "GLOBAL_SEND_INTERVAL", 0)
+        monkeypatch.setattr(telegram_alert, "CHAT_SEND_INTERVAL", 0)
+        yield server
@@ -0,0 +1,159 @@
+import glob
+import json
+import math
+import os
+import re
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import requests
+
+# ==========================================
+# 🧪 LOCAL REPLAY SERVER FOR TESTS
+# ==========================================
+# One HTTP server standing in for all three external services:
+#   GET  /resource/<id>?offset=&limit=   data.gov.in mandi feed, replayed from recorded pages
+#   GET  /table/v1/driving/<coords>      OSRM table service (great-circle km x ROAD_FACTOR)
+#   POST /bot<token>/sendMessage         Telegram Bot API
+# Point db_updater.API_BASE, agro_core.OSRM_URL and telegram_alert.TELEGRAM_API at `url`.
+FEED_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "mandi_feed")
+ROAD_FACTOR = 1.3
+
+def load_recorded_pages(feed_dir=FEED_DIR):
+    """{offset: page body} for every page_<offset>.json in feed_dir."""
+    pages = {}
+    for path in glob.glob(os.path.join(feed_dir, "page_*.json")):
+        with open(path) as f:
+            page = json.load(f)
+        pages[int(page["offset"])] = page
+    return pages
+
+def record_pages(api_base, api_key, pages=3, page_size=4, feed_dir=FEED_DIR):
+    """Saves the first `pages` pages of the live feed as fixtures (run by hand, never from tests)."""
+    os.makedirs(feed_dir, exist_ok=True)
+    for offset in range(0, pages * page_size, page_size):
+        params = {"api-key": api_key, "format": "json", "limit": page_size, "offset": offset}
+        body = requests.get(api_base, params=params, timeout=30).json()
+        with open(os.path.join(feed_dir, f"page_{offset:06d}.json"), "w") as f:
+            json.dump(body, f, indent=1)
+
+def _haversine_m(a, b):
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000.0 * math.asin(math.sqrt(h))
+
+class ReplayServer:
+    """Threaded replay server; the attributes below script failures and record what was asked.
+
+    feed_fail_from: page offsets >= this answer HTTP 403, like an exhausted API key mid-walk.
+    osrm_fail: every /table call answers HTTP 400.
+    bot_script: queued (status, body) answers for sendMessage; once empty every message succeeds.
+    """
+
+    def __init__(self, pages=None, shift_dates=True):
+        self.pages = load_recorded_pages() if pages is None else pages
+        self.shift_dates = shift_dates
+        self.feed_fail_from = None
+        self.osrm_fail = False
+        self.bot_script = []
+        self.feed_offsets = []      # offset of every feed request, in arrival order
+        self.osrm_calls = []        # (n_sources, n_destinations) per /table call
+        self.sent = []              # every sendMessage payload
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self._httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- data.gov.in ---
+    def _date_shift(self):
+        # Recorded pages are replayed as if the newest recorded day were today, so pruning keeps them
+        if not self.shift_dates:
+            return timedelta(0)
+        days = [datetime.strptime(r["arrival_date"], "%d/%m/%Y") for p in self.pages.values() for r in p["records"]]
+        return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - max(days) if days else timedelta(0)
+
+    def feed_page(self, offset):
+        with self._lock:
+            self.feed_offsets.append(offset)
+        if self.feed_fail_from is not None and offset >= self.feed_fail_from:
+            return 403, {"error": "replay: feed_fail_from"}
+        if offset not in self.pages:
+            total = next(iter(self.pages.values()))["total"] if self.pages else 0
+            return 200, {"total": total, "count": 0, "offset": str(offset), "records": []}
+        page = json.loads(json.dumps(self.pages[offset]))
+        shift = self._date_shift()
+        for rec in page["records"]:
+            day = datetime.strptime(rec["arrival_date"], "%d/%m/%Y") + shift
+            rec["arrival_date"] = day.strftime("%d/%m/%Y")
+        return 200, page
+
+    # --- OSRM ---
+    def osrm_table(self, coords, query):
+        points = [tuple(reversed([float(v) for v in p.split(",")])) for p in coords.split(";")]
+        sources = [int(i) for i in query["sources"][0].split(";")] if "sources" in query else range(len(points))
+        dests = [int(i) for i in query["destinations"][0].split(";")] if "destinations" in query else range(len(points))
+        with self._lock:
+            self.osrm_calls.append((len(sources), len(dests)))
+        if self.osrm_fail:
+            return 400, {"code": "InvalidQuery", "message": "replay: osrm_fail"}
+        distances = [[_haversine_m(points[i], points[j]) * ROAD_FACTOR for j in dests] for i in sources]
+        return 200, {"code": "Ok", "distances": distances}
+
+    # --- Telegram Bot API ---
+    def send_message(self, payload):
+        with self._lock:
+            self.sent.append(payload)
+            if self.bot_script:
+                return self.bot_script.pop(0)
+            return 200, {"ok": True, "result": {"message_id": len(self.sent), "chat": {"id": payload.get("chat_id")}}}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                query = parse_qs(parts.query)
+                table = re.match(r"^/table/v1/driving/(.+)$", parts.path)
+                if parts.path.startswith("/resource/"):
+                    self._reply(*server.feed_page(int(query.get("offset", ["0"])[0])))
+                elif table:
+                    self._reply(*server.osrm_table(table.group(1), query))
+                else:
+                    self._reply(404, {"error": f"replay: no route for {parts.path}"})
+
+            def do_POST(self):
+                if re.match(r"^/bot[^/]+/sendMessage$", self.path):
+                    length = int(self.headers.get("Content-Length") or 0)
+                    self._reply(*server.send_message(json.loads(self.rfile.read(length) or b"{}")))
+                else:
+                    self._reply(404, {"ok": False, "description": "Not Found"})
+
+        return Handler
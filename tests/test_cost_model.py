@@ -0,0 +1,11 @@
+import agro_core
+
+def test_feed_varieties_and_spellings_use_their_base_crop_profile():
+    model = agro_core.cost_model()
+    paddy = (agro_core.CROP_PROFILES["paddy"]["wastage"], agro_core.CROP_PROFILES["paddy"]["labor"])
+    soybean = (agro_core.CROP_PROFILES["soybean"]["wastage"], agro_core.CROP_PROFILES["soybean"]["labor"])
+    assert model._profile("Paddy(Dhan)(Common)") == paddy
+    assert model._profile("dhan") == paddy
+    assert model._profile("Soyabean") == soybean
+    assert model._profile("Soybean") == soybean
+    assert model._profile("Dragon Fruit") == (agro_core.CROP_PROFILES["default"]["wastage"], agro_core.CROP_PROFILES["default"]["labor"])
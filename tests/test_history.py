@@ -0,0 +1,41 @@
+from datetime import date, timedelta
+import numpy as np
+import agro_core
+import db_updater
+
+def _ingest_daily_prices(days, monkeypatch):
+    # One market, price = 100 + days ago, so every weekly mean is easy to check; fed through the streaming ingest
+    today = date.today()
+    records = [{"state": "Chhattisgarh", "market": "Raipur", "commodity": "Tomato", "modal_price": str(100 + d),
+                "arrival_date": (today - timedelta(days=d)).strftime("%d/%m/%Y")} for d in range(days)]
+    monkeypatch.setattr(db_updater, "_fetch_page", lambda session, offset: {"total": len(records), "records": records[offset:offset + db_updater.PAGE_SIZE]})
+    assert db_updater.ingest_national_feed() == days
+
+def test_short_windows_are_daily(tmp_db, monkeypatch):
+    _ingest_daily_prices(70, monkeypatch)
+    series, day_numbers, prices, resolution = agro_core.load_price_history("tomato", days=14)
+    assert resolution == "daily"
+    assert series == [("Raipur", "Tomato")]
+    assert prices.shape == (1, 14) and len(day_numbers) == 14
+    assert prices[0, -1] == 100.0
+
+def test_long_windows_fall_back_to_weekly_rollups(tmp_db, monkeypatch):
+    _ingest_daily_prices(70, monkeypatch)
+    # Older days were rolled out of price_history by the prune
+    today = (date.today() - date(1970, 1, 1)).days
+    assert tmp_db.execute("SELECT MIN(day) FROM price_history").fetchone()[0] > today - 70
+
+    series, day_numbers, prices, resolution = agro_core.load_price_history("tomato", days=63)
+    assert resolution == "weekly"
+    assert prices.shape == (1, 9)
+    assert np.all(day_numbers % 7 == 0)
+    for week_start, mean in zip(day_numbers, prices[0]):
+        expected = [100 + today - d for d in range(week_start, week_start + 7) if today - 70 < d <= today]
+        assert mean == np.mean(expected)
+
+def test_rolling_stats_over_weekly_history(tmp_db, monkeypatch):
+    _ingest_daily_prices(70, monkeypatch)
+    stats = agro_core.rolling_price_stats("tomato", window=35, days=63)
+    assert stats["samples"].tolist() == [5]
+    # Prices fall by 1 a day towards today
+    assert stats["trend_pct_per_day"].iloc[0] < 0
@@ -0,0 +1,45 @@
+import agro_core
+import db_updater
+
+def _stored(conn):
+    return conn.execute("SELECT COUNT(*) FROM mandi_prices").fetchone()[0]
+
+def _checkpoint(conn):
+    return conn.execute("SELECT next_offset, total, finished FROM ingest_checkpoint WHERE feed = ?", (db_updater.FEED_NAME,)).fetchone()
+
+def test_full_ingest_stores_every_valid_record(tmp_db, replay):
+    # 11 recorded records, one with modal_price "NR"
+    assert db_updater.ingest_national_feed() == 10
+    assert _stored(tmp_db) == 10
+    assert _checkpoint(tmp_db) == (11, 11, 1)
+    assert sorted(set(replay.feed_offsets)) == [0, 4, 8]
+
+def test_interrupted_ingest_resumes_from_checkpoint(tmp_db, replay):
+    replay.feed_fail_from = 8
+    # Pages 0 and 4 land (7 valid records, "NR" skipped); page 8 is refused
+    assert db_updater.ingest_national_feed() == 7
+    assert _stored(tmp_db) == 7
+    assert _checkpoint(tmp_db) == (8, None, 0)
+
+    replay.feed_fail_from = None
+    replay.feed_offsets.clear()
+    assert db_updater.ingest_national_feed() == 3
+    assert replay.feed_offsets == [8]
+    assert _stored(tmp_db) == 10
+    assert _checkpoint(tmp_db) == (11, 11, 1)
+
+def test_resume_false_walks_the_feed_again(tmp_db, replay):
+    replay.feed_fail_from = 4
+    db_updater.ingest_national_feed()
+    replay.feed_fail_from = None
+    replay.feed_offsets.clear()
+    db_updater.ingest_national_feed(resume=False)
+    assert replay.feed_offsets[0] == 0
+    assert _stored(tmp_db) == 10
+
+def test_replayed_prices_resolve_to_variety_ids(tmp_db, replay):
+    db_updater.ingest_national_feed()
+    common, basmati = agro_core.resolve_commodity("Paddy(Dhan)(Common)"), agro_core.resolve_commodity("Paddy(Dhan)(Basmati)")
+    assert len(common) == len(basmati) == 1 and common != basmati
+    assert set(agro_core.resolve_commodity("paddy")) == {*common, *basmati}
+    assert agro_core.resolve_commodity("soybean") == agro_core.resolve_commodity("Soyabean")
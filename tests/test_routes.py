@@ -0,0 +1,33 @@
+import agro_core
+
+MARKETS = {"Raipur": (21.25, 81.63), "Durg": (21.19, 81.28), "Bilaspur": (22.08, 82.15), "Raigarh": (21.90, 83.40)}
+
+def _seed_locations(conn):
+    with conn:
+        conn.executemany("INSERT INTO location_cache (city_name, lat, lon) VALUES (?, ?, ?)",
+                         [(name, lat, lon) for name, (lat, lon) in MARKETS.items()])
+    agro_core.load_location_index(refresh=True)
+
+def test_prefetch_routes_fills_route_cache_in_table_chunks(tmp_db, replay, monkeypatch):
+    monkeypatch.setattr(agro_core, "OSRM_TABLE_CHUNK", 2)
+    _seed_locations(tmp_db)
+    names = list(MARKETS)
+    routes = agro_core.prefetch_routes(names)
+
+    assert len(routes) == len(names) * (len(names) - 1)
+    assert all(n_src <= 2 and n_dst <= 2 for n_src, n_dst in replay.osrm_calls)
+    assert tmp_db.execute("SELECT COUNT(*) FROM route_cache").fetchone()[0] == len(routes)
+    assert 40 < routes[("Raipur", "Durg")] < 60
+
+    # Everything is cached now, so a second prefetch makes no calls
+    replay.osrm_calls.clear()
+    assert agro_core.prefetch_routes(names) == routes
+    assert replay.osrm_calls == []
+
+def test_prefetch_routes_reports_failed_pairs(tmp_db, replay):
+    _seed_locations(tmp_db)
+    replay.osrm_fail = True
+    failed = set()
+    pairs = [("Raipur", "Durg"), ("Durg", "Bilaspur")]
+    assert agro_core.prefetch_routes(None, pairs=pairs, failed=failed) == {}
+    assert failed == set(pairs)
@@ -0,0 +1,37 @@
+import telegram_alert
+
+def test_long_messages_are_split_and_sent_in_order(replay):
+    paragraphs = [f"Deal {i}: " + "x" * 900 for i in range(10)]
+    results = telegram_alert.send_messages([("-100", "\n\n".join(paragraphs))])
+
+    assert all(r["ok"] for r in results) and len(results) > 1
+    assert all(len(p["text"]) <= telegram_alert.MAX_MESSAGE_CHARS for p in replay.sent)
+    assert "\n\n".join(p["text"] for p in replay.sent) == "\n\n".join(paragraphs)
+
+def test_rate_limited_send_is_retried_after_retry_after(replay):
+    replay.bot_script = [(429, {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 0}})]
+    [result] = telegram_alert.send_messages([("-100", "hello")])
+    assert result == {"chat_id": "-100", "ok": True, "attempts": 2, "error": None}
+
+def test_markdown_errors_fall_back_to_plain_text(replay):
+    replay.bot_script = [(400, {"ok": False, "error_code": 400, "description": "Bad Request: can't parse entities"})]
+    [result] = telegram_alert.send_messages([("-100", "Kota_APMC *deal")])
+    assert result["ok"]
+    assert "parse_mode" in replay.sent[0] and "parse_mode" not in replay.sent[1]
+
+def test_rejected_messages_are_reported_not_retried(replay):
+    replay.bot_script = [(403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was kicked"})]
+    [result] = telegram_alert.send_messages([("-100", "hello")])
+    assert result == {"chat_id": "-100", "ok": False, "attempts": 1, "error": "Forbidden: bot was kicked"}
+    assert len(replay.sent) == 1
+
+def test_no_backoff_after_the_final_attempt(replay, monkeypatch):
+    slept = []
+    async def fake_sleep(seconds):
+        slept.append(seconds)
+    monkeypatch.setattr(telegram_alert.asyncio, "sleep", fake_sleep)
+    monkeypatch.setattr(telegram_alert, "MAX_SEND_ATTEMPTS", 3)
+    replay.bot_script = [(502, {"ok": False, "description": "Bad Gateway"})] * 3
+    [result] = telegram_alert.send_messages([("-100", "hello")])
+    assert not result["ok"] and result["attempts"] == 3
+    assert slept == [2, 4]